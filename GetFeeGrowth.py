@@ -1,12 +1,22 @@
 import requests
 import os
 from dotenv import load_dotenv
+from metrics import METRICS
+from subgraph_decoder import (
+    MalformedResponseError,
+    SubgraphConnectionError,
+    SubgraphError,
+    SubgraphHTTPError,
+    decode_graphql_body,
+)
 
 # 加载环境变量
 load_dotenv()
 
 URL = os.getenv("GRAPH_API_URL")
 API_KEY = os.getenv("GRAPH_API_KEY")
+# 子图请求的超时时间（秒）
+SUBGRAPH_TIMEOUT = 30
 
 def build_query(pool_id, block_number, tick):
     tick_id = f"{pool_id}#{tick}"
@@ -34,31 +44,41 @@ def fetch_pool_data(pool_id, block_number, tick):
         "Authorization": f"Bearer {API_KEY}"
     }
     query = build_query(pool_id, block_number, tick)
-    resp = requests.post(URL, json={'query': query}, headers=headers)
+    METRICS.incr("fetch_count")
     try:
-        res = resp.json()
-    except Exception:
-        print("API返回内容不是JSON：", resp.text)
-        return None, None, None, None, None
-    if 'data' not in res or 'pool' not in res['data']:
-        print("API返回异常：", res)
-        return None, None, None, None, None
-    
-    pool_data = res['data']['pool']
-    if not pool_data or 'ticks' not in pool_data or not pool_data['ticks']:
-        print("没有查询到 tick 数据")
-        print("API返回内容：", res)
-        return None, None, None, None, None
-    
-    tick_data = pool_data['ticks'][0]
-    pool_info = tick_data['pool']
-    
-    # 直接返回多个变量
-    fee_growth_outside_0_x128 = int(tick_data['feeGrowthOutside0X128'])
-    fee_growth_outside_1_x128 = int(tick_data['feeGrowthOutside1X128'])
-    fee_growth_global_0_x128 = int(pool_info['feeGrowthGlobal0X128'])
-    fee_growth_global_1_x128 = int(pool_info['feeGrowthGlobal1X128'])
-    current_tick = int(pool_data['tick'])
+        with METRICS.stage("fetch"):
+            try:
+                resp = requests.post(URL, json={'query': query}, headers=headers, timeout=SUBGRAPH_TIMEOUT)
+            except requests.RequestException as exc:
+                raise SubgraphConnectionError(f"请求子图失败: {exc!r}")
+        METRICS.incr("fetch_bytes", len(resp.content))
+        if resp.status_code >= 400:
+            raise SubgraphHTTPError(resp.status_code, resp.text[:200])
+        with METRICS.stage("json_decode"):
+            data = decode_graphql_body(resp.content)
+        if 'pool' not in data:
+            raise MalformedResponseError("响应缺少 pool 字段")
+        
+        pool_data = data['pool']
+        if not pool_data or not pool_data.get('ticks'):
+            # 该区块下池子不存在或tick未初始化
+            return None, None, None, None, None
+        
+        # 直接返回多个变量
+        with METRICS.stage("parse"):
+            try:
+                tick_data = pool_data['ticks'][0]
+                pool_info = tick_data['pool']
+                fee_growth_outside_0_x128 = int(tick_data['feeGrowthOutside0X128'])
+                fee_growth_outside_1_x128 = int(tick_data['feeGrowthOutside1X128'])
+                fee_growth_global_0_x128 = int(pool_info['feeGrowthGlobal0X128'])
+                fee_growth_global_1_x128 = int(pool_info['feeGrowthGlobal1X128'])
+                current_tick = int(pool_data['tick'])
+            except (KeyError, IndexError, TypeError, ValueError) as exc:
+                raise MalformedResponseError(f"tick数据格式错误: {exc!r}")
+    except SubgraphError:
+        METRICS.incr("fetch_errors")
+        raise
     
     return fee_growth_outside_0_x128, fee_growth_outside_1_x128, fee_growth_global_0_x128, fee_growth_global_1_x128, current_tick
 
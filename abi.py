@@ -0,0 +1,103 @@
+# Uniswap V3 池子合约与Multicall3的最小ABI编解码（不依赖web3）
+
+# 函数选择器
+SLOT0_SELECTOR = bytes.fromhex("3850c7bd")                   # slot0()
+FEE_GROWTH_GLOBAL_0_SELECTOR = bytes.fromhex("f3058399")     # feeGrowthGlobal0X128()
+FEE_GROWTH_GLOBAL_1_SELECTOR = bytes.fromhex("46141319")     # feeGrowthGlobal1X128()
+TICKS_SELECTOR = bytes.fromhex("f30dba93")                   # ticks(int24)
+AGGREGATE3_SELECTOR = bytes.fromhex("82ad56cb")              # aggregate3((address,bool,bytes)[])
+
+
+def encode_word(value: int) -> bytes:
+    # 负数按256位补码编码
+    return (value % (1 << 256)).to_bytes(32, "big")
+
+
+def decode_word(data: bytes, offset: int) -> int:
+    if offset + 32 > len(data):
+        raise ValueError("ABI数据长度不足")
+    return int.from_bytes(data[offset:offset + 32], "big")
+
+
+def to_signed(value: int) -> int:
+    return value - (1 << 256) if value >> 255 else value
+
+
+def pad_bytes(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 32)
+
+
+def encode_ticks_call(tick: int) -> bytes:
+    return TICKS_SELECTOR + encode_word(tick)
+
+
+def encode_aggregate3(calls: list[tuple[str, bytes]]) -> bytes:
+    """
+    编码 aggregate3 调用，每个子调用都允许失败
+
+    参数:
+    - calls: [(合约地址, calldata), ...]
+
+    返回:
+    - bytes: calldata
+    """
+    heads, tails = [], []
+    offset = 32 * len(calls)
+    for target, data in calls:
+        heads.append(encode_word(offset))
+        tail = encode_word(int(target, 16)) + encode_word(1) + encode_word(0x60) + encode_word(len(data)) + pad_bytes(data)
+        tails.append(tail)
+        offset += len(tail)
+    return AGGREGATE3_SELECTOR + encode_word(0x20) + encode_word(len(calls)) + b"".join(heads) + b"".join(tails)
+
+
+def decode_aggregate3_calls(calldata: bytes) -> list[tuple[str, bytes]]:
+    """
+    解码 aggregate3 的calldata（供本地测试桩使用）
+
+    返回:
+    - list[tuple[str, bytes]]: [(合约地址, calldata), ...]
+    """
+    data = calldata[4:]
+    start = decode_word(data, 0) + 32
+    calls = []
+    for i in range(decode_word(data, start - 32)):
+        item = start + decode_word(data, start + 32 * i)
+        bytes_start = item + decode_word(data, item + 64)
+        length = decode_word(data, bytes_start)
+        calls.append((f"0x{decode_word(data, item):040x}", data[bytes_start + 32:bytes_start + 32 + length]))
+    return calls
+
+
+def encode_aggregate3_result(results: list[tuple[bool, bytes]]) -> bytes:
+    """
+    编码 aggregate3 的返回值（供本地测试桩使用）
+
+    参数:
+    - results: [(是否成功, 返回数据), ...]
+    """
+    heads, tails = [], []
+    offset = 32 * len(results)
+    for success, data in results:
+        heads.append(encode_word(offset))
+        tail = encode_word(int(success)) + encode_word(0x40) + encode_word(len(data)) + pad_bytes(data)
+        tails.append(tail)
+        offset += len(tail)
+    return encode_word(0x20) + encode_word(len(results)) + b"".join(heads) + b"".join(tails)
+
+
+def decode_aggregate3_result(data: bytes) -> list[tuple[bool, bytes]]:
+    """
+    解码 aggregate3 的返回值
+
+    返回:
+    - list[tuple[bool, bytes]]: [(是否成功, 返回数据), ...]
+    """
+    start = decode_word(data, 0) + 32
+    results = []
+    for i in range(decode_word(data, start - 32)):
+        item = start + decode_word(data, start + 32 * i)
+        bytes_start = item + decode_word(data, item + 32)
+        length = decode_word(data, bytes_start)
+        results.append((decode_word(data, item) != 0, data[bytes_start + 32:bytes_start + 32 + length]))
+    return results
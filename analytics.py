@@ -0,0 +1,262 @@
+import math
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import accumulate
+from typing import NamedTuple
+
+from fee_calculator import compute_position_fees
+from data_sources import default_data_source
+from block_resolver import BlockResolver, default_block_resolver, resolve_blocks
+from errors import DataSourceError
+from query_planner import PoolSnapshot
+
+# 以太坊合并后的出块间隔（秒），无法查询区块时间戳时用于把区块区间换算为时间
+SECONDS_PER_BLOCK = 12
+SECONDS_PER_YEAR = 365 * 24 * 3600
+
+
+class Position(NamedTuple):
+    pool_id: str
+    tick_lower: int
+    tick_upper: int
+    liquidity: int
+
+
+class PositionAnalytics(NamedTuple):
+    """
+    单个头寸在采样窗口内的分析结果
+
+    金额均为token1最小单位（token0按窗口结束时的价格折算）；缺少边界tick数据或起止区块的快照时手续费相关字段为None，
+    池子在窗口内没有任何快照时所有指标都为None
+    """
+    position: Position
+    time_in_range: float        # 价格处于 [tick_lower, tick_upper) 内的时间占比
+    fees_0: int                 # 窗口内产生的token0手续费（最小单位）
+    fees_1: int                 # 窗口内产生的token1手续费（最小单位）
+    fee_value: float            # 手续费总价值
+    fee_apr: float              # 手续费年化收益率（相对HODL价值，即窗口开始时持有的代币按结束价格计价）
+    impermanent_loss: float     # LP价值 / HODL价值 - 1（不含手续费）
+    net_vs_hodl: float          # (LP价值 + 手续费) / HODL价值 - 1
+
+
+def sample_blocks(start_block: int, end_block: int, samples: int) -> list[int]:
+    """
+    在 [start_block, end_block] 内均匀取样，包含两个端点
+
+    参数:
+    - start_block: 起始区块
+    - end_block: 结束区块
+    - samples: 采样数量（至少为2）
+
+    返回:
+    - list[int]: 升序且去重的区块号
+    """
+    start_block, end_block = int(start_block), int(end_block)
+    if end_block < start_block:
+        raise ValueError(f"结束区块 {end_block} 早于起始区块 {start_block}")
+    if samples < 2 or end_block == start_block:
+        return sorted({start_block, end_block})
+    step = (end_block - start_block) / (samples - 1)
+    return sorted({start_block + round(i * step) for i in range(samples)})
+
+
+def position_amounts(liquidity: int, tick: int, tick_lower: int, tick_upper: int) -> tuple[float, float]:
+    """
+    按Uniswap V3公式计算头寸在给定价格下持有的两种代币数量（最小单位）
+
+    参数:
+    - liquidity: 流动性数量
+    - tick: 当前tick
+    - tick_lower: 下边界tick
+    - tick_upper: 上边界tick
+
+    返回:
+    - tuple[float, float]: (token0数量, token1数量)
+    """
+    sqrt_price = 1.0001 ** (tick / 2)
+    sqrt_lower = 1.0001 ** (tick_lower / 2)
+    sqrt_upper = 1.0001 ** (tick_upper / 2)
+    if tick < tick_lower:
+        return liquidity * (1 / sqrt_lower - 1 / sqrt_upper), 0.0
+    if tick >= tick_upper:
+        return 0.0, liquidity * (sqrt_upper - sqrt_lower)
+    return liquidity * (1 / sqrt_price - 1 / sqrt_upper), liquidity * (sqrt_price - sqrt_lower)
+
+
+class TickDistribution:
+    """
+    采样区块上当前tick的时间加权分布
+
+    每个采样点代表到下一个采样点之间的区块区间；按tick排序后做前缀和，
+    任意区间 [tick_lower, tick_upper) 的停留时间只需两次二分查找
+    """
+
+    def __init__(self, snapshots: dict[int, PoolSnapshot]):
+        blocks = sorted(snapshots)
+        weighted = sorted(
+            (snapshots[block].tick_current, next_block - block)
+            for block, next_block in zip(blocks, blocks[1:])
+        )
+        self.ticks = [tick for tick, _ in weighted]
+        self.prefix = [0] + list(accumulate(weight for _, weight in weighted))
+        self.total = self.prefix[-1]
+
+    def fraction_in_range(self, tick_lower: int, tick_upper: int) -> float:
+        if not self.total:
+            return 0.0
+        inside = self.prefix[bisect_left(self.ticks, tick_upper)] - self.prefix[bisect_left(self.ticks, tick_lower)]
+        return inside / self.total
+
+
+def analyze_pool(
+    positions: list[Position],
+    snapshots: dict[int, PoolSnapshot],
+    seconds_per_block: float = SECONDS_PER_BLOCK,
+    window_seconds: float = None
+) -> list[PositionAnalytics]:
+    """
+    基于同一个池子的采样快照批量计算头寸分析指标
+
+    参数:
+    - positions: 同一个池子的头寸列表
+    - snapshots: 采样区块 -> 快照；第一个和最后一个区块的快照需要包含所有头寸的边界tick
+    - seconds_per_block: 出块间隔（秒），未传入 window_seconds 时用于估算窗口时长
+    - window_seconds: 第一个到最后一个采样区块的实际时长（秒），用于年化手续费
+
+    返回:
+    - list[PositionAnalytics]: 与 positions 顺序一致
+    """
+    blocks = sorted(snapshots)
+    start, end = snapshots[blocks[0]], snapshots[blocks[-1]]
+    distribution = TickDistribution(snapshots)
+    price_end = 1.0001 ** end.tick_current
+    if window_seconds is None:
+        window_seconds = (blocks[-1] - blocks[0]) * seconds_per_block
+    annualize = SECONDS_PER_YEAR / window_seconds if window_seconds else 0.0
+
+    results = []
+    for position in positions:
+        amount_0_start, amount_1_start = position_amounts(position.liquidity, start.tick_current, position.tick_lower, position.tick_upper)
+        amount_0_end, amount_1_end = position_amounts(position.liquidity, end.tick_current, position.tick_lower, position.tick_upper)
+        # HODL价值和起始价值都按结束价格计价，使两者可比
+        hodl_value = amount_0_start * price_end + amount_1_start
+        lp_value = amount_0_end * price_end + amount_1_end
+        impermanent_loss = lp_value / hodl_value - 1 if hodl_value else 0.0
+
+        fees = compute_position_fees(start, end, position.tick_lower, position.tick_upper, position.liquidity)
+        if fees is None:
+            fees_0 = fees_1 = fee_value = fee_apr = net_vs_hodl = None
+        else:
+            fees_0, _, fees_1, _ = fees
+            fee_value = fees_0 * price_end + fees_1
+            fee_apr = fee_value / hodl_value * annualize if hodl_value else 0.0
+            net_vs_hodl = (lp_value + fee_value) / hodl_value - 1 if hodl_value else 0.0
+
+        results.append(PositionAnalytics(
+            position=position,
+            time_in_range=distribution.fraction_in_range(position.tick_lower, position.tick_upper),
+            fees_0=fees_0,
+            fees_1=fees_1,
+            fee_value=fee_value,
+            fee_apr=fee_apr,
+            impermanent_loss=impermanent_loss,
+            net_vs_hodl=net_vs_hodl
+        ))
+    return results
+
+
+def analyze_portfolio(
+    positions: list[Position],
+    start_block: int,
+    end_block: int,
+    samples: int = 1000,
+    fetch=None,
+    seconds_per_block: float = SECONDS_PER_BLOCK,
+    block_resolver: BlockResolver = None
+) -> list[PositionAnalytics]:
+    """
+    计算一组头寸在区块窗口内的手续费APR、无常损失和在区间内的时间占比
+
+    每个池子只获取一次采样区块的快照（不含tick），以及起止区块上所有头寸边界tick的快照
+
+    参数:
+    - positions: 头寸列表，可以来自不同的池子
+    - start_block: 窗口起始区块，也可以是时间（见 block_resolver.to_timestamp）
+    - end_block: 窗口结束区块，也可以是时间
+    - samples: 采样区块数量
+    - fetch: 快照获取函数，签名同 fetch_snapshots（也可以传入 SnapshotCache.get），默认使用 default_data_source()
+    - seconds_per_block: 出块间隔（秒），无法查询起止区块的时间戳时用于估算窗口时长
+    - block_resolver: 区块解析器，用于把时间解析为区块和查询起止区块的时间戳，默认使用 default_block_resolver()
+
+    返回:
+    - list[PositionAnalytics]: 与 positions 顺序一致；池子缺少起止区块的快照时，
+      无常损失和区间内时间占比按已有的采样快照计算，手续费相关字段为None
+    """
+    fetch = fetch or default_data_source().get_snapshots
+    resolver = block_resolver or default_block_resolver()
+    start_block, end_block = resolve_blocks([start_block, end_block], resolver)
+    blocks = sample_blocks(start_block, end_block, samples)
+    # 窗口时长优先使用起止区块的实际时间戳（合并前出块间隔约13秒且不均匀），查询不到时按出块间隔估算
+    try:
+        timestamps = resolver.block_timestamps([blocks[0], blocks[-1]])
+    except DataSourceError:
+        timestamps = {}
+    window_seconds = None
+    if blocks[0] in timestamps and blocks[-1] in timestamps:
+        window_seconds = timestamps[blocks[-1]] - timestamps[blocks[0]]
+    by_pool: dict[str, list[int]] = defaultdict(list)
+    for index, position in enumerate(positions):
+        by_pool[position.pool_id].append(index)
+
+    results: list[PositionAnalytics] = [None] * len(positions)
+    for pool_id, indexes in by_pool.items():
+        pool_positions = [positions[index] for index in indexes]
+        ticks = {tick for position in pool_positions for tick in (position.tick_lower, position.tick_upper)}
+        snapshots = dict(fetch(pool_id, blocks[1:-1], []))
+        snapshots.update(fetch(pool_id, [blocks[0], blocks[-1]], sorted(ticks)))
+        if not snapshots:
+            pool_results = [PositionAnalytics(position, *[None] * 7) for position in pool_positions]
+        else:
+            pool_results = analyze_pool(pool_positions, snapshots, seconds_per_block, window_seconds)
+            if blocks[0] not in snapshots or blocks[-1] not in snapshots:
+                # 窗口不完整，与缺少边界tick时一样不计算手续费
+                pool_results = [
+                    analytics._replace(fees_0=None, fees_1=None, fee_value=None, fee_apr=None, net_vs_hodl=None)
+                    for analytics in pool_results
+                ]
+        for index, analytics in zip(indexes, pool_results):
+            results[index] = analytics
+    return results
+
+
+# 示例用法：用合成数据演示 1万个头寸 × 1000个采样点 的计算耗时
+if __name__ == "__main__":
+    import random
+    import time
+
+    random.seed(7)
+    pool_id = "0x4e68ccd3e89f51c3074ca5072bbac773960dfa36"
+    blocks = sample_blocks(18408173, 23438173, 1000)
+    positions = []
+    for _ in range(10000):
+        tick_lower = -200000 + 60 * random.randint(0, 100)
+        positions.append(Position(pool_id, tick_lower, tick_lower + 60 * random.randint(1, 100), random.randint(10 ** 15, 10 ** 18)))
+
+    all_ticks = {tick for position in positions for tick in (position.tick_lower, position.tick_upper)}
+    snapshots = {}
+    for i, block in enumerate(blocks):
+        # 边界tick外侧增长取0：窗口起止都在区间内的头寸获得全部全局增长，其余为0
+        ticks = {tick: (0, 0) for tick in all_ticks} if i in (0, len(blocks) - 1) else {}
+        snapshots[block] = PoolSnapshot(block, -197000 + int(3000 * math.sin(i / 50)), i * 2 ** 128 // 10 ** 5, i * 2 ** 128 // 10 ** 14, ticks)
+
+    start = time.perf_counter()
+    results = analyze_pool(positions, snapshots)
+    elapsed = time.perf_counter() - start
+    print(f"{len(positions)} 个头寸 × {len(blocks)} 个采样点，耗时 {elapsed:.2f}s")
+    best = max(results, key=lambda analytics: analytics.fee_apr)
+    print(f"平均在区间内时间占比: {sum(analytics.time_in_range for analytics in results) / len(results):.2%}")
+    print(
+        f"APR最高的头寸 [{best.position.tick_lower}, {best.position.tick_upper}] "
+        f"在区间内: {best.time_in_range:.2%}, APR: {best.fee_apr:.2%}, "
+        f"无常损失: {best.impermanent_loss:.4%}, 相对HODL: {best.net_vs_hodl:.4%}"
+    )
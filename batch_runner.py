@@ -0,0 +1,491 @@
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import NamedTuple
+
+from analytics import SECONDS_PER_BLOCK, Position, PositionAnalytics, analyze_portfolio
+from block_resolver import resolve_blocks
+from data_sources import default_data_source
+from snapshot_bundle import BundleRecorder, SnapshotBundle
+from snapshot_cache import SnapshotCache
+
+# 分布式批量计算：协调者按池子把头寸切成分片写入SQLite队列，多个工作进程（可以在共享该文件的多台机器上）
+# 认领分片并写回结果。每个分片预先分配给一个工作进程，同一池子的分片分配给同一个进程以复用快照缓存；
+# 自己的分片做完后，空闲的进程从剩余分片最多的进程那里窃取。
+
+MAX_SHARD_POSITIONS = 500   # 单个分片的头寸数上限，大池子按tick排序后切成多个分片
+LEASE_SECONDS = 600         # 分片的租约超过该时间未续租，视为工作进程已退出，允许其他进程重新认领
+LEASE_RENEW_POSITIONS = 100 # 工作进程每计算这么多个头寸续租一次
+MAX_ATTEMPTS = 3            # 分片的最大尝试次数（包括失败和租约过期）
+POLL_INTERVAL = 0.2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    pool_id TEXT NOT NULL,
+    owner INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    payload TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    worker INTEGER,
+    stolen INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS shards_state ON shards (state, owner);
+"""
+
+
+class ShardFailedError(Exception):
+    """
+    有分片在多次尝试后仍然失败
+    """
+
+
+class Shard(NamedTuple):
+    id: int
+    pool_id: str
+    owner: int
+    payload: dict
+    stolen: bool
+
+
+def partition_positions(positions: list[Position], max_shard_positions: int = MAX_SHARD_POSITIONS) -> list[tuple[str, list[int]]]:
+    """
+    按池子切分头寸；同一池子的头寸按区间排序后再按数量切分，相邻区间共享边界tick
+
+    参数:
+    - positions: 头寸列表
+    - max_shard_positions: 单个分片的头寸数上限
+
+    返回:
+    - list[tuple[str, list[int]]]: [(池子地址, 头寸下标列表), ...]
+    """
+    by_pool: dict[str, list[int]] = defaultdict(list)
+    for index, position in enumerate(positions):
+        by_pool[position.pool_id.lower()].append(index)
+    shards = []
+    for pool_id, indexes in by_pool.items():
+        indexes.sort(key=lambda index: (positions[index].tick_lower, positions[index].tick_upper))
+        for i in range(0, len(indexes), max_shard_positions):
+            shards.append((pool_id, indexes[i:i + max_shard_positions]))
+    return shards
+
+
+def assign_owners(shards: list[tuple[str, list[int]]], workers: int) -> list[int]:
+    """
+    把池子分配给工作进程：按池子头寸数从大到小，依次分给当前负载最小的进程（同一池子的分片归同一个进程）
+
+    返回:
+    - list[int]: 与 shards 对应的工作进程编号
+    """
+    pool_sizes: dict[str, int] = defaultdict(int)
+    for pool_id, indexes in shards:
+        pool_sizes[pool_id] += len(indexes)
+    loads = [0] * max(1, workers)
+    owners = {}
+    for pool_id in sorted(pool_sizes, key=lambda pool_id: (-pool_sizes[pool_id], pool_id)):
+        owner = loads.index(min(loads))
+        owners[pool_id] = owner
+        loads[owner] += pool_sizes[pool_id]
+    return [owners[pool_id] for pool_id, _ in shards]
+
+
+class ShardQueue:
+    """
+    基于SQLite的分片队列，多个进程通过同一个数据库文件认领分片；认领在 BEGIN IMMEDIATE 事务中完成，保证不会重复认领
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def enqueue(self, shards: list[tuple[str, int, dict]]) -> None:
+        """
+        参数:
+        - shards: [(池子地址, 预分配的工作进程编号, 分片内容), ...]
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.executemany(
+            "INSERT INTO shards (pool_id, owner, payload, size) VALUES (?, ?, ?, ?)",
+            [(pool_id, owner, json.dumps(payload), len(payload["positions"])) for pool_id, owner, payload in shards]
+        )
+        self._conn.execute("COMMIT")
+
+    def claim(self, worker_id: int, warm_pools=()) -> Shard:
+        """
+        认领一个分片，优先顺序:
+        1. 分配给自己的分片
+        2. 自己已经缓存过的池子的分片
+        3. 剩余分片最多的进程队尾的分片
+
+        返回:
+        - Shard: 认领到的分片，没有可认领的分片时返回None
+        """
+        now = time.time()
+        claimable = "(state = 'pending' OR (state = 'running' AND lease_expires < ?))"
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 租约过期说明工作进程在处理中退出（如内存不足被杀），已达到尝试次数上限的分片不再重新认领，
+            # 否则每次都会让认领它的进程退出，批量计算永远无法结束
+            self._conn.execute(
+                "UPDATE shards SET state = 'failed', lease_expires = NULL, "
+                "error = COALESCE(error || '; ', '') || ? WHERE state = 'running' AND lease_expires < ? AND attempts >= ?",
+                (f"工作进程在租约内未完成，已尝试 {MAX_ATTEMPTS} 次", now, MAX_ATTEMPTS)
+            )
+            row = self._conn.execute(
+                f"SELECT id, pool_id, owner, payload FROM shards WHERE {claimable} AND owner = ? ORDER BY pool_id, id LIMIT 1",
+                (now, worker_id)
+            ).fetchone()
+            if row is None and warm_pools:
+                row = self._conn.execute(
+                    f"SELECT id, pool_id, owner, payload FROM shards WHERE {claimable} AND pool_id IN ({','.join('?' * len(warm_pools))}) "
+                    "ORDER BY id DESC LIMIT 1",
+                    (now, *warm_pools)
+                ).fetchone()
+            if row is None:
+                row = self._conn.execute(
+                    f"SELECT id, pool_id, owner, payload FROM shards AS s WHERE {claimable} ORDER BY "
+                    f"(SELECT SUM(size) FROM shards WHERE owner = s.owner AND {claimable}) DESC, id DESC LIMIT 1",
+                    (now, now)
+                ).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            shard_id, pool_id, owner, payload = row
+            stolen = owner != worker_id
+            self._conn.execute(
+                "UPDATE shards SET state = 'running', worker = ?, stolen = ?, attempts = attempts + 1, lease_expires = ? WHERE id = ?",
+                (worker_id, int(stolen), now + LEASE_SECONDS, shard_id)
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return Shard(shard_id, pool_id, owner, json.loads(payload), stolen)
+
+    def complete(self, shard_id: int, worker_id: int, result) -> None:
+        # 租约过期后被其他进程重新认领的分片，以先完成的结果为准
+        self._conn.execute(
+            "UPDATE shards SET state = 'done', result = ?, lease_expires = NULL WHERE id = ? AND state = 'running' AND worker = ?",
+            (json.dumps(result), shard_id, worker_id)
+        )
+
+    def renew(self, shard_id: int, worker_id: int) -> bool:
+        """
+        延长分片的租约，处理时间较长的分片在计算过程中定期调用
+
+        返回:
+        - bool: 是否仍持有该分片；租约过期后已被其他进程重新认领或被标记为失败时为False
+        """
+        cursor = self._conn.execute(
+            "UPDATE shards SET lease_expires = ? WHERE id = ? AND state = 'running' AND worker = ?",
+            (time.time() + LEASE_SECONDS, shard_id, worker_id)
+        )
+        return cursor.rowcount > 0
+
+    def fail(self, shard_id: int, worker_id: int, error: str) -> None:
+        self._conn.execute(
+            "UPDATE shards SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, lease_expires = NULL "
+            "WHERE id = ? AND state = 'running' AND worker = ?",
+            (MAX_ATTEMPTS, error, shard_id, worker_id)
+        )
+
+    def counts(self) -> dict[str, int]:
+        return dict(self._conn.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall())
+
+    def results(self):
+        """
+        返回:
+        - 迭代器: (分片结果, 完成的工作进程, 是否为窃取)
+        """
+        for result, worker, stolen in self._conn.execute("SELECT result, worker, stolen FROM shards WHERE state = 'done'"):
+            yield json.loads(result), worker, bool(stolen)
+
+    def errors(self) -> list[tuple[int, str, str]]:
+        return self._conn.execute("SELECT id, pool_id, error FROM shards WHERE state = 'failed'").fetchall()
+
+
+def run_worker(queue_path: str, worker_id: int, fetch=None) -> int:
+    """
+    工作进程主循环：认领分片并计算，直到队列中没有待处理和处理中的分片
+
+    整个进程共用一个 SnapshotCache 和默认数据源（及其连接池），跨分片复用；
+    分片按 LEASE_RENEW_POSITIONS 个头寸分块计算，每块之后续租，租约已被其他进程接手时放弃该分片
+
+    参数:
+    - queue_path: 队列数据库路径
+    - worker_id: 工作进程编号
+    - fetch: 快照获取函数，默认使用 default_data_source()
+
+    返回:
+    - int: 完成的分片数量
+    """
+    cache = SnapshotCache(fetch=fetch or default_data_source().get_snapshots)
+    queue = ShardQueue(queue_path)
+    warm_pools: set[str] = set()
+    completed = 0
+    try:
+        while True:
+            shard = queue.claim(worker_id, sorted(warm_pools))
+            if shard is None:
+                counts = queue.counts()
+                if not counts.get("pending") and not counts.get("running"):
+                    return completed
+                # 其他进程还有未完成的分片，等待其完成或租约过期
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            payload = shard.payload
+            positions = [Position(shard.pool_id, tick_lower, tick_upper, liquidity) for _, tick_lower, tick_upper, liquidity in payload["positions"]]
+            analytics = []
+            try:
+                # 先取整个分片的边界tick，各块只查询其中一部分，直接命中缓存
+                ticks = sorted({tick for position in positions for tick in (position.tick_lower, position.tick_upper)})
+                cache.get(shard.pool_id, [payload["start_block"], payload["end_block"]], ticks)
+                for i in range(0, len(positions), LEASE_RENEW_POSITIONS):
+                    analytics.extend(analyze_portfolio(
+                        positions[i:i + LEASE_RENEW_POSITIONS],
+                        payload["start_block"],
+                        payload["end_block"],
+                        payload["samples"],
+                        fetch=cache.get,
+                        seconds_per_block=payload["seconds_per_block"]
+                    ))
+                    if not queue.renew(shard.id, worker_id):
+                        break
+            except Exception as exc:
+                queue.fail(shard.id, worker_id, f"{type(exc).__name__}: {exc}")
+                continue
+            if len(analytics) < len(positions):
+                # 租约已被其他进程接手，由它写回结果
+                continue
+            warm_pools.add(shard.pool_id)
+            queue.complete(shard.id, worker_id, [
+                [index] + list(item[1:]) for (index, *_), item in zip(payload["positions"], analytics)
+            ])
+            completed += 1
+    finally:
+        queue.close()
+
+
+def run_batch(
+    positions: list[Position],
+    start_block,
+    end_block,
+    samples: int = 1000,
+    workers: int = 4,
+    queue_path: str = None,
+    max_shard_positions: int = MAX_SHARD_POSITIONS,
+    seconds_per_block: float = SECONDS_PER_BLOCK,
+    timeout: float = None
+) -> tuple[list[PositionAnalytics], dict]:
+    """
+    协调者：切分头寸、写入队列、启动本机工作进程并合并结果
+
+    参数:
+    - positions: 头寸列表
+    - start_block: 窗口起始区块，也可以是时间（见 block_resolver.to_timestamp）
+    - end_block: 窗口结束区块，也可以是时间
+    - samples: 采样区块数量
+    - workers: 本机启动的工作进程数；为0时只写入队列，等待其他机器上用
+      `python batch_runner.py worker --queue <path> --worker-id <n>` 启动的工作进程，此时必须指定 queue_path
+    - queue_path: 队列数据库路径，默认使用临时文件（结束后删除）
+    - max_shard_positions: 单个分片的头寸数上限
+    - seconds_per_block: 出块间隔（秒）
+    - timeout: 等待结果的超时时间（秒），默认不限
+
+    设置了 LP_FEE_RECORD_BUNDLE 时，本机工作进程分别记录到 <路径>.worker<n>，结束后由协调者合并，
+    在协调者退出时一起写出；其他机器上的工作进程需要各自使用不同的路径
+
+    返回:
+    - tuple[list[PositionAnalytics], dict]: (与 positions 顺序一致的结果, 统计信息)
+    """
+    if workers < 0:
+        raise ValueError(f"工作进程数不能为负数: {workers}")
+    if workers == 0 and queue_path is None:
+        raise ValueError("workers 为0时必须指定 queue_path，否则其他机器上的工作进程无法连接临时队列")
+    # 时间只在协调者解析一次，所有工作进程使用相同的区块
+    start_block, end_block = resolve_blocks([start_block, end_block])
+    temporary = queue_path is None
+    if temporary:
+        fd, queue_path = tempfile.mkstemp(prefix="lp_fee_batch_", suffix=".sqlite")
+        os.close(fd)
+
+    shards = partition_positions(positions, max_shard_positions)
+    owners = assign_owners(shards, workers)
+    queue = ShardQueue(queue_path)
+    processes = []
+    try:
+        queue.enqueue([
+            (pool_id, owner, {
+                "positions": [
+                    [index, positions[index].tick_lower, positions[index].tick_upper, positions[index].liquidity]
+                    for index in indexes
+                ],
+                "start_block": start_block,
+                "end_block": end_block,
+                "samples": samples,
+                "seconds_per_block": seconds_per_block,
+            })
+            for (pool_id, indexes), owner in zip(shards, owners)
+        ])
+        start = time.perf_counter()
+        record_path = os.getenv("LP_FEE_RECORD_BUNDLE")
+        for worker_id in range(workers):
+            env = dict(os.environ)
+            if record_path:
+                # 各工作进程继承同一个路径时会在退出时互相覆盖
+                env["LP_FEE_RECORD_BUNDLE"] = _worker_bundle_path(record_path, worker_id)
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "worker", "--queue", queue_path, "--worker-id", str(worker_id)],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env
+            ))
+
+        while True:
+            counts = queue.counts()
+            if counts.get("done", 0) + counts.get("failed", 0) == len(shards):
+                break
+            if processes and all(process.poll() is not None for process in processes):
+                raise ShardFailedError(f"所有工作进程已退出，但仍有未完成的分片: {counts}")
+            if timeout is not None and time.perf_counter() - start > timeout:
+                raise TimeoutError(f"等待分片结果超时: {counts}")
+            time.sleep(POLL_INTERVAL)
+
+        failed = queue.errors()
+        if failed:
+            raise ShardFailedError(f"{len(failed)} 个分片失败，例如池子 {failed[0][1]}: {failed[0][2]}")
+
+        results: list[PositionAnalytics] = [None] * len(positions)
+        per_worker: dict[int, int] = defaultdict(int)
+        stolen = 0
+        for shard_result, worker, was_stolen in queue.results():
+            per_worker[worker] += 1
+            stolen += was_stolen
+            for index, *fields in shard_result:
+                results[index] = PositionAnalytics(positions[index], *fields)
+        stats = {
+            "shards": len(shards),
+            "stolen": stolen,
+            "per_worker": dict(sorted(per_worker.items())),
+            "elapsed": time.perf_counter() - start,
+        }
+        return results, stats
+    finally:
+        for process in processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if processes and os.getenv("LP_FEE_RECORD_BUNDLE"):
+            _merge_worker_bundles(os.getenv("LP_FEE_RECORD_BUNDLE"), len(processes))
+        queue.close()
+        if temporary:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(queue_path + suffix):
+                    os.remove(queue_path + suffix)
+
+
+def _worker_bundle_path(record_path: str, worker_id: int) -> str:
+    return f"{record_path}.worker{worker_id}"
+
+
+def _merge_worker_bundles(record_path: str, workers: int) -> None:
+    # 把工作进程记录的快照包合并进本进程的记录器，进程退出时写出到 record_path
+    recorder = default_data_source()
+    for worker_id in range(workers):
+        path = _worker_bundle_path(record_path, worker_id)
+        if not os.path.exists(path):
+            continue
+        if isinstance(recorder, BundleRecorder):
+            with SnapshotBundle(path) as bundle:
+                recorder.merge_bundle(bundle)
+        os.remove(path)
+
+
+def _demo(args) -> None:
+    import random
+
+    from stub_servers import StubSubgraphHandler, start_stub_server
+
+    # 工作进程继承环境变量，连接本进程中的假子图
+    stub_server, stub_handler = start_stub_server(StubSubgraphHandler, latency=args.stub_latency)
+    os.environ["GRAPH_API_URL"] = f"http://127.0.0.1:{stub_server.server_address[1]}/"
+
+    random.seed(7)
+    positions = []
+    for i in range(args.positions):
+        # 池子大小不均匀，用来观察窃取
+        pool_id = f"0x{random.randint(0, args.pools - 1) ** 2 % args.pools:040x}"
+        tick_lower = -196000 + 60 * random.randint(0, 30)
+        positions.append(Position(pool_id, tick_lower, tick_lower + 60 * random.randint(1, 30), random.randint(10 ** 15, 10 ** 18)))
+
+    results, stats = run_batch(positions, 18408173, 23438173, samples=args.samples, workers=args.workers, max_shard_positions=args.shard_size)
+    print(f"{len(positions)} 个头寸, {stats['shards']} 个分片, {args.workers} 个工作进程, 耗时 {stats['elapsed']:.2f}s")
+    print(f"各进程完成的分片数: {stats['per_worker']}, 窃取的分片数: {stats['stolen']}, 子图请求数: {stub_handler.request_count}")
+
+    if args.verify:
+        from data_sources import SubgraphSource
+
+        # 本进程的默认子图地址在设置环境变量之前已经读取，这里显式指定
+        source = SubgraphSource(os.environ["GRAPH_API_URL"])
+        expected = analyze_portfolio(positions, 18408173, 23438173, samples=args.samples, fetch=SnapshotCache(fetch=source.get_snapshots).get)
+        print(f"与单进程结果一致: {results == expected}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="分片的分布式批量计算")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker = commands.add_parser("worker", help="启动一个工作进程")
+    worker.add_argument("--queue", required=True, help="队列数据库路径")
+    worker.add_argument("--worker-id", type=int, required=True)
+
+    run = commands.add_parser("run", help="计算头寸文件中所有头寸，结果写为JSON")
+    run.add_argument("positions_file", help="JSON数组，每一项为 [pool_id, tick_lower, tick_upper, liquidity]")
+    run.add_argument("--start", required=True, help="起始区块或时间")
+    run.add_argument("--end", required=True, help="结束区块或时间")
+    run.add_argument("--samples", type=int, default=1000)
+    run.add_argument("--workers", type=int, default=os.cpu_count())
+    run.add_argument("--queue", default=None, help="队列数据库路径，需要其他机器上的工作进程参与时指定共享路径")
+    run.add_argument("--output", default="-")
+
+    demo = commands.add_parser("demo", help="用假子图演示")
+    demo.add_argument("--positions", type=int, default=5000)
+    demo.add_argument("--pools", type=int, default=40)
+    demo.add_argument("--samples", type=int, default=200)
+    demo.add_argument("--workers", type=int, default=4)
+    demo.add_argument("--shard-size", type=int, default=MAX_SHARD_POSITIONS)
+    demo.add_argument("--stub-latency", type=float, default=0.02)
+    demo.add_argument("--verify", action="store_true", help="与单进程计算结果比较")
+
+    args = parser.parse_args()
+    if args.command == "worker":
+        run_worker(args.queue, args.worker_id)
+    elif args.command == "run":
+        with open(args.positions_file, encoding="utf-8") as f:
+            positions = [Position(str(pool_id), int(lower), int(upper), int(liquidity)) for pool_id, lower, upper, liquidity in json.load(f)]
+        results, stats = run_batch(positions, args.start, args.end, args.samples, args.workers, args.queue)
+        output = json.dumps([item._asdict() | {"position": list(item.position)} for item in results])
+        if args.output == "-":
+            print(output)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(output)
+        print(f"{stats['shards']} 个分片, 窃取 {stats['stolen']} 个, 耗时 {stats['elapsed']:.2f}s", file=sys.stderr)
+    else:
+        _demo(args)
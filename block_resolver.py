@@ -0,0 +1,322 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+from datetime import date, datetime, timezone
+
+from data_sources import atomic_write, default_data_source
+from errors import DataSourceError
+from snapshot_bundle import SnapshotBundle
+
+# 前几轮按时间线性插值猜测区块号，之后退回二分，保证出块间隔很不均匀时也能收敛
+MAX_INTERPOLATION_ROUNDS = 4
+# 最新区块的缓存时间（秒），约一个出块间隔
+HEAD_TTL = 12.0
+
+
+def to_timestamp(value) -> int:
+    """
+    把时间转换为Unix时间戳（秒）
+
+    参数:
+    - value: int/float 时间戳、datetime（无时区时按UTC）、date（UTC零点）、
+      ISO格式字符串（如 "2025-01-01"、"2025-01-01T08:00:00+08:00"）或 "now"
+
+    返回:
+    - int: 时间戳
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"无法识别的时间: {value!r}")
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        text = value.strip()
+        if text.lower() == "now":
+            return int(time.time())
+        if text.isdigit():
+            return int(text)
+        try:
+            value = datetime.fromisoformat(text.replace("Z", "+00:00"))
+        except ValueError:
+            raise ValueError(f"无法识别的时间: {value!r}")
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp())
+    if isinstance(value, date):
+        return int(datetime(value.year, value.month, value.day, tzinfo=timezone.utc).timestamp())
+    raise ValueError(f"无法识别的时间: {value!r}")
+
+
+def is_block_number(value) -> bool:
+    """
+    int 或纯数字字符串视为区块号，其余（日期、datetime、"now"）视为时间
+    """
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return True
+    return isinstance(value, str) and value.strip().isdigit()
+
+
+class BlockIndex:
+    """
+    按区块号排序的 区块号 -> 时间戳 索引，可以持久化为JSON文件
+
+    区块时间戳随区块号递增，两个列表同时有序，按时间戳二分就能找到夹住目标时间的两个已知区块
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.blocks: list[int] = []
+        self.timestamps: list[int] = []
+        self._dirty = False
+        if path:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            raise DataSourceError(f"区块索引文件损坏: {self.path}: {exc}")
+        self.blocks = [int(block) for block in record["blocks"]]
+        self.timestamps = [int(timestamp) for timestamp in record["timestamps"]]
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def add(self, timestamps: dict[int, int]) -> None:
+        """
+        合并新的 区块号 -> 时间戳
+        """
+        known = dict(zip(self.blocks, self.timestamps))
+        new = {int(block): int(timestamp) for block, timestamp in timestamps.items() if int(block) not in known}
+        if not new:
+            return
+        known.update(new)
+        self.blocks = sorted(known)
+        self.timestamps = [known[block] for block in self.blocks]
+        self._dirty = True
+
+    def bracket(self, timestamp: int) -> tuple:
+        """
+        参数:
+        - timestamp: 目标时间戳
+
+        返回:
+        - tuple: ((区块号, 时间戳) 不晚于目标的最后一个已知区块, (区块号, 时间戳) 晚于目标的第一个已知区块)，
+          不存在时对应位置为None
+        """
+        i = bisect_right(self.timestamps, timestamp)
+        lower = (self.blocks[i - 1], self.timestamps[i - 1]) if i > 0 else None
+        upper = (self.blocks[i], self.timestamps[i]) if i < len(self.blocks) else None
+        return lower, upper
+
+    def save(self) -> None:
+        """
+        有新数据时写回文件（先写唯一的临时文件再替换）
+        """
+        if not self.path or not self._dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with atomic_write(self.path) as f:
+            json.dump({"blocks": self.blocks, "timestamps": self.timestamps}, f)
+        self._dirty = False
+
+
+class BlockResolver:
+    """
+    按时间查找区块：先在本地索引中二分，索引中夹住目标时间的两个区块不相邻时，
+    按时间线性插值猜测区块号并向数据源查询，结果写回索引
+
+    同一批时间戳每一轮的探测区块合并为一次 get_block_timestamps 请求；
+    索引中已经解析过的时间附近的查询不需要再请求数据源
+    """
+
+    def __init__(self, source=None, index: BlockIndex = None, head_ttl: float = HEAD_TTL):
+        # 快照包和记录器定义了 __len__，空的实例为假值，不能用 or 判断
+        self.source = source if source is not None else default_data_source()
+        self.index = index if index is not None else BlockIndex()
+        self.head_ttl = head_ttl
+        self._head = None
+        self._head_time = 0.0
+        self._lock = threading.Lock()
+
+    def _latest(self) -> tuple[int, int]:
+        now = time.monotonic()
+        if self._head is None or now - self._head_time > self.head_ttl:
+            self._head = self.source.get_latest_block()
+            self._head_time = now
+            self.index.add({self._head[0]: self._head[1]})
+        return self._head
+
+    def latest_block(self) -> int:
+        """
+        返回:
+        - int: 最新区块号（缓存 head_ttl 秒）；数据源不能查询区块时（如只配置了子图）为其 get_head_block，
+          即子图已索引到的区块，都无法提供时为None
+        """
+        with self._lock:
+            if not self.source.block_queries:
+                now = time.monotonic()
+                if self._head is None or now - self._head_time > self.head_ttl:
+                    # 没有时间戳，不写入索引
+                    self._head = (self.source.get_head_block(), None)
+                    self._head_time = now
+                return self._head[0]
+            try:
+                return self._latest()[0]
+            finally:
+                self.index.save()
+
+    def block_timestamps(self, block_numbers) -> dict[int, int]:
+        """
+        查询区块的时间戳，索引中已有的区块不再请求数据源
+
+        参数:
+        - block_numbers: 区块号列表
+
+        返回:
+        - dict[int, int]: 区块号 -> 时间戳，尚未产生的区块不包含在内；
+          数据源不能查询区块时（如只配置了子图）只包含索引中已有的区块
+        """
+        wanted = {int(block) for block in block_numbers}
+        with self._lock:
+            known = dict(zip(self.index.blocks, self.index.timestamps))
+            missing = sorted(wanted - known.keys())
+            if missing and self.source.block_queries:
+                try:
+                    self.index.add(self.source.get_block_timestamps(missing))
+                finally:
+                    self.index.save()
+                known = dict(zip(self.index.blocks, self.index.timestamps))
+        return {block: known[block] for block in wanted if block in known}
+
+    def block_at(self, value) -> int:
+        """
+        返回:
+        - int: 时间戳不晚于 value 的最后一个区块，value 的格式见 to_timestamp
+        """
+        return self.blocks_at([value])[0]
+
+    def blocks_at(self, values) -> list[int]:
+        """
+        批量把时间解析为区块号
+
+        参数:
+        - values: 时间列表，格式见 to_timestamp
+
+        返回:
+        - list[int]: 与 values 顺序一致，每一项是时间戳不晚于该时间的最后一个区块；晚于最新区块的时间解析为最新区块
+        """
+        targets = [to_timestamp(value) for value in values]
+        with self._lock:
+            try:
+                return self._resolve(targets)
+            finally:
+                self.index.save()
+
+    def _resolve(self, targets: list[int]) -> list[int]:
+        head_block, head_timestamp = self._latest()
+        if self.index.blocks[0] != 0 and any(target < self.index.timestamps[0] for target in targets):
+            self._fetch([0])
+
+        resolved: dict[int, int] = {}
+        pending = set()
+        for target in targets:
+            if target >= head_timestamp:
+                resolved[target] = head_block
+            elif target < self.index.timestamps[0]:
+                raise ValueError(f"时间 {target} 早于创世区块")
+            else:
+                pending.add(target)
+
+        rounds = 0
+        while pending:
+            probes = set()
+            for target in list(pending):
+                (lower_block, lower_timestamp), (upper_block, upper_timestamp) = self.index.bracket(target)
+                if upper_block - lower_block == 1:
+                    resolved[target] = lower_block
+                    pending.discard(target)
+                    continue
+                if rounds < MAX_INTERPOLATION_ROUNDS:
+                    guess = lower_block + (target - lower_timestamp) * (upper_block - lower_block) // (upper_timestamp - lower_timestamp)
+                else:
+                    guess = (lower_block + upper_block) // 2
+                guess = min(max(guess, lower_block + 1), upper_block - 1)
+                # 同时探测猜测区块的下一个区块，猜中时一轮即可确定
+                probes.add(guess)
+                if guess + 1 < upper_block:
+                    probes.add(guess + 1)
+            if probes:
+                self._fetch(sorted(probes))
+            rounds += 1
+        return [resolved[target] for target in targets]
+
+    def _fetch(self, blocks: list[int]) -> None:
+        fetched = self.source.get_block_timestamps(blocks)
+        missing = [block for block in blocks if block not in fetched]
+        if missing:
+            raise DataSourceError(f"数据源缺少区块的时间戳: {missing[:10]}")
+        self.index.add(fetched)
+
+
+def resolve_blocks(values, resolver: BlockResolver = None) -> list[int]:
+    """
+    把区块号或时间的混合列表统一解析为区块号；只有包含时间时才会使用 resolver
+
+    参数:
+    - values: 区块号（int或纯数字字符串）或时间（格式见 to_timestamp）
+    - resolver: 区块解析器，默认使用 default_block_resolver()
+
+    返回:
+    - list[int]: 与 values 顺序一致的区块号
+    """
+    values = list(values)
+    times = [value for value in values if not is_block_number(value)]
+    if not times:
+        return [int(value) for value in values]
+    resolved = iter((resolver or default_block_resolver()).blocks_at(times))
+    return [int(value) if is_block_number(value) else next(resolved) for value in values]
+
+
+_default_resolver = None
+
+
+def default_block_resolver() -> BlockResolver:
+    """
+    创建（并缓存）使用 default_data_source() 的区块解析器，索引文件路径:
+    - LP_FEE_BLOCK_INDEX: 索引文件
+    - 未设置时使用 LP_FEE_SNAPSHOT_DIR 下的 block_index.json；两者都未设置时只保存在内存中
+    - 从快照包离线重放（LP_FEE_BUNDLE）时，索引只使用快照包中记录的区块时间戳
+
+    返回:
+    - BlockResolver: 区块解析器
+    """
+    global _default_resolver
+    if _default_resolver is None:
+        source = default_data_source()
+        if isinstance(source, SnapshotBundle):
+            index = BlockIndex()
+            index.add(source.block_timestamps)
+            _default_resolver = BlockResolver(source, index)
+            return _default_resolver
+        path = os.getenv("LP_FEE_BLOCK_INDEX")
+        if not path and os.getenv("LP_FEE_SNAPSHOT_DIR"):
+            path = os.path.join(os.getenv("LP_FEE_SNAPSHOT_DIR"), "block_index.json")
+        _default_resolver = BlockResolver(source, BlockIndex(path))
+    return _default_resolver
+
+
+# 示例用法
+if __name__ == "__main__":
+    resolver = default_block_resolver()
+    start, end = resolver.blocks_at(["2025-01-01", "now"])
+    print(f"2025-01-01 -> 区块 {start}, now -> 区块 {end}, 索引中已知区块数: {len(resolver.index)}")
@@ -0,0 +1,402 @@
+import atexit
+import contextlib
+import json
+import os
+import secrets
+
+import requests
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，退回不加锁（只有单个进程写同一个快照目录时才安全）
+    fcntl = None
+
+from errors import DataSourceError
+from GetFeeGrowth import URL
+from metrics import METRICS
+from query_planner import PoolSnapshot, fetch_indexed_block, fetch_snapshots, plan_batches
+
+# 请求失败时切换到下一个数据源
+_FALLBACK_ERRORS = (DataSourceError, requests.RequestException)
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    """
+    在目标文件所在目录创建唯一的临时文件供写入，正常退出后原子替换目标文件，出错时删除临时文件；
+    多个线程或进程同时写同一个文件时不会互相覆盖临时文件
+
+    参数:
+    - path: 目标文件路径
+    - mode: "w"（文本，UTF-8）或 "wb"
+
+    返回:
+    - 上下文管理器，产出临时文件对象
+    """
+    while True:
+        tmp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+        try:
+            # 与普通 open 一样以0666创建、由内核应用umask（mkstemp 固定为0600），O_EXCL 保证不会打开别人的临时文件
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, mode, encoding=None if "b" in mode else "utf-8") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def record_to_snapshot(block: int, record: dict) -> PoolSnapshot:
+    """
+    把快照的JSON记录（FileSource 和快照包共用的格式）转换为 PoolSnapshot
+    """
+    return PoolSnapshot(
+        block_number=int(block),
+        tick_current=record["tick"],
+        fee_growth_global_0_x128=int(record["feeGrowthGlobal0X128"]),
+        fee_growth_global_1_x128=int(record["feeGrowthGlobal1X128"]),
+        ticks={int(tick): (int(values[0]), int(values[1])) for tick, values in record["ticks"].items()}
+    )
+
+
+def merge_snapshot_record(record: dict, snapshot: PoolSnapshot, ticks) -> dict:
+    """
+    把快照合并进JSON记录（record 为None时新建），tick与已有记录合并
+
+    参数:
+    - record: 已有记录
+    - snapshot: 快照
+    - ticks: 本次查询的tick列表（包括未初始化、不在快照中的tick）
+
+    返回:
+    - dict: 合并后的记录
+    """
+    record = record or {"queried_ticks": [], "ticks": {}}
+    record.update({
+        "tick": snapshot.tick_current,
+        "feeGrowthGlobal0X128": str(snapshot.fee_growth_global_0_x128),
+        "feeGrowthGlobal1X128": str(snapshot.fee_growth_global_1_x128),
+        "queried_ticks": sorted(set(record["queried_ticks"]) | {int(tick) for tick in ticks}),
+    })
+    record["ticks"].update({str(tick): [str(values[0]), str(values[1])] for tick, values in snapshot.ticks.items()})
+    return record
+
+
+class DataSource:
+    """
+    池子状态数据源接口
+
+    子类实现 get_snapshots（批量接口，签名与 fetch_snapshots 相同）和 cost；
+    get_slot0 / get_globals / get_ticks 是基于它的单区块便捷方法；
+    能查询区块时间的数据源把 block_queries 设为True，并实现 get_block_timestamps / get_latest_block（见 block_resolver）
+    """
+    name = "base"
+    # 是否能查询任意区块的时间戳和最新区块，调用 get_block_timestamps / get_latest_block 前先检查
+    block_queries = False
+
+    def cost(self, pool_id: str, block_numbers, ticks) -> float:
+        """
+        估算完成该查询的代价，返回None表示该数据源无法提供
+        """
+        return None
+
+    def get_snapshots(self, pool_id: str, block_numbers, ticks) -> dict[int, PoolSnapshot]:
+        raise NotImplementedError
+
+    def get_block_timestamps(self, block_numbers) -> dict[int, int]:
+        """
+        返回:
+        - dict[int, int]: 区块号 -> 时间戳（秒），尚未产生的区块不包含在内
+        """
+        raise DataSourceError(f"数据源 {self.name} 不能查询区块时间戳")
+
+    def get_latest_block(self) -> tuple[int, int]:
+        """
+        返回:
+        - tuple[int, int]: (最新区块号, 时间戳)
+        """
+        raise DataSourceError(f"数据源 {self.name} 不能查询最新区块")
+
+    def get_head_block(self) -> int:
+        """
+        返回:
+        - int: 数据源能提供数据的最新区块号（不需要时间戳时使用），无法提供时为None
+        """
+        return self.get_latest_block()[0] if self.block_queries else None
+
+    def get_slot0(self, pool_id: str, block_number: int) -> int:
+        """
+        返回:
+        - int: 该区块的当前tick，无数据时为None
+        """
+        snapshot = self.get_snapshots(pool_id, [block_number], []).get(int(block_number))
+        return snapshot.tick_current if snapshot else None
+
+    def get_globals(self, pool_id: str, block_number: int) -> tuple[int, int]:
+        """
+        返回:
+        - tuple[int, int]: (全局token0手续费增长, 全局token1手续费增长)，无数据时为 (None, None)
+        """
+        snapshot = self.get_snapshots(pool_id, [block_number], []).get(int(block_number))
+        if snapshot is None:
+            return None, None
+        return snapshot.fee_growth_global_0_x128, snapshot.fee_growth_global_1_x128
+
+    def get_ticks(self, pool_id: str, block_number: int, ticks) -> dict:
+        """
+        返回:
+        - dict: tick -> (fee_growth_outside_0_x128, fee_growth_outside_1_x128)，只包含已初始化的tick
+        """
+        snapshot = self.get_snapshots(pool_id, [block_number], ticks).get(int(block_number))
+        return dict(snapshot.ticks) if snapshot else {}
+
+
+class SubgraphSource(DataSource):
+    """
+    The Graph 子图数据源（见 query_planner）
+    """
+    name = "subgraph"
+
+    def __init__(self, url: str = URL, request_cost: float = 1.0, session: requests.Session = None):
+        self.url = url
+        self.request_cost = request_cost
+        self.session = session or requests.Session()
+
+    def cost(self, pool_id: str, block_numbers, ticks) -> float:
+        if not self.url:
+            return None
+        return len(plan_batches(block_numbers, ticks)) * self.request_cost
+
+    def get_snapshots(self, pool_id: str, block_numbers, ticks) -> dict[int, PoolSnapshot]:
+        return fetch_snapshots(pool_id, block_numbers, ticks, url=self.url, session=self.session)
+
+    def get_head_block(self) -> int:
+        # 子图没有任意区块的时间戳，但 _meta 给出已索引到的区块
+        if not self.url:
+            return None
+        return fetch_indexed_block(url=self.url, session=self.session)
+
+
+class FileSource(DataSource):
+    """
+    本地文件数据源，每个 (pool, block) 一个JSON文件: {root}/{pool_id}/{block}.json
+
+    文件中记录了查询过的tick集合，请求的tick不全在其中时视为没有该区块的数据
+    """
+    name = "file"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, pool_id: str, block: int) -> str:
+        return os.path.join(self.root, pool_id.lower(), f"{int(block)}.json")
+
+    def _load(self, pool_id: str, block: int):
+        try:
+            with open(self._path(pool_id, block), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            raise DataSourceError(f"快照文件损坏: {self._path(pool_id, block)}: {exc}")
+
+    def cost(self, pool_id: str, block_numbers, ticks) -> float:
+        # 只检查文件是否存在，tick是否齐全在读取时判断；缺少的区块由路由交给下一个数据源
+        if any(os.path.exists(self._path(pool_id, block)) for block in block_numbers):
+            return 0.0
+        return None
+
+    def get_snapshots(self, pool_id: str, block_numbers, ticks) -> dict[int, PoolSnapshot]:
+        wanted = {int(tick) for tick in ticks}
+        snapshots = {}
+        for block in {int(block) for block in block_numbers}:
+            record = self._load(pool_id, block)
+            if record is None or not wanted <= set(record["queried_ticks"]):
+                continue
+            snapshots[block] = record_to_snapshot(block, record)
+        return snapshots
+
+    def save_snapshots(self, pool_id: str, snapshots: dict[int, PoolSnapshot], ticks) -> None:
+        """
+        保存快照，与已有文件中的tick合并
+
+        参数:
+        - pool_id: 池子地址
+        - snapshots: 区块号 -> 快照
+        - ticks: 本次查询的tick列表（包括未初始化、不在快照中的tick）
+        """
+        directory = os.path.join(self.root, pool_id.lower())
+        os.makedirs(directory, exist_ok=True)
+        # 读取-合并-写回期间持有池子目录的文件锁，多个进程同时写同一区块时不会丢失对方的tick
+        with open(os.path.join(directory, ".lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            for block, snapshot in snapshots.items():
+                record = merge_snapshot_record(self._load(pool_id, block), snapshot, ticks)
+                with atomic_write(self._path(pool_id, block)) as f:
+                    json.dump(record, f)
+
+
+class DataSourceRouter(DataSource):
+    """
+    按代价从低到高依次尝试各数据源：前一个数据源缺少的区块（如子图索引滞后）或请求失败时，
+    剩余区块交给下一个数据源；从远程取到的快照可以写回本地文件数据源
+    """
+    name = "router"
+
+    def __init__(self, sources: list, write_through: FileSource = None):
+        self.sources = list(sources)
+        self.write_through = write_through
+
+    def cost(self, pool_id: str, block_numbers, ticks) -> float:
+        costs = [cost for cost in (source.cost(pool_id, block_numbers, ticks) for source in self.sources) if cost is not None]
+        return min(costs) if costs else None
+
+    def get_snapshots(self, pool_id: str, block_numbers, ticks) -> dict[int, PoolSnapshot]:
+        remaining = sorted({int(block) for block in block_numbers})
+        candidates = []
+        for index, source in enumerate(self.sources):
+            cost = source.cost(pool_id, remaining, ticks)
+            if cost is not None:
+                candidates.append((cost, index, source))
+        candidates.sort(key=lambda candidate: candidate[:2])
+        if remaining and not candidates:
+            raise DataSourceError("没有配置可用的数据源")
+
+        snapshots: dict[int, PoolSnapshot] = {}
+        last_error = None
+        for _, _, source in candidates:
+            if not remaining:
+                break
+            try:
+                fetched = source.get_snapshots(pool_id, remaining, ticks)
+            except _FALLBACK_ERRORS as exc:
+                METRICS.incr(f"{source.name}_errors")
+                last_error = exc
+                continue
+            METRICS.incr(f"{source.name}_snapshots", len(fetched))
+            if self.write_through is not None and source is not self.write_through and fetched:
+                self.write_through.save_snapshots(pool_id, fetched, ticks)
+            snapshots.update(fetched)
+            remaining = [block for block in remaining if block not in fetched]
+
+        # 所有数据源都失败时抛出最后一个错误；部分成功时返回已取到的区块
+        if last_error is not None and not snapshots:
+            raise last_error
+        return snapshots
+
+    @property
+    def block_queries(self) -> bool:
+        return bool(self._block_sources())
+
+    def _block_sources(self):
+        # 子图和本地文件没有任意区块的时间戳，只使用能查询区块的数据源
+        return [source for source in self.sources if source.block_queries]
+
+    def get_block_timestamps(self, block_numbers) -> dict[int, int]:
+        remaining = sorted({int(block) for block in block_numbers})
+        sources = self._block_sources()
+        if not sources:
+            raise DataSourceError("没有可以查询区块时间戳的数据源（需要设置 ETH_RPC_URL）")
+        timestamps: dict[int, int] = {}
+        last_error = None
+        for source in sources:
+            if not remaining:
+                break
+            try:
+                fetched = source.get_block_timestamps(remaining)
+            except _FALLBACK_ERRORS as exc:
+                METRICS.incr(f"{source.name}_errors")
+                last_error = exc
+                continue
+            timestamps.update(fetched)
+            remaining = [block for block in remaining if block not in fetched]
+        if last_error is not None and not timestamps:
+            raise last_error
+        return timestamps
+
+    def get_latest_block(self) -> tuple[int, int]:
+        sources = self._block_sources()
+        if not sources:
+            raise DataSourceError("没有可以查询区块时间戳的数据源（需要设置 ETH_RPC_URL）")
+        for source in sources:
+            try:
+                return source.get_latest_block()
+            except _FALLBACK_ERRORS as exc:
+                METRICS.incr(f"{source.name}_errors")
+                last_error = exc
+        raise last_error
+
+    def get_head_block(self) -> int:
+        # 优先用能查询区块的数据源给出的链上最新区块，只配置了子图时用子图已索引到的区块
+        last_error = None
+        for source in sorted(self.sources, key=lambda source: not source.block_queries):
+            try:
+                head = source.get_head_block()
+            except _FALLBACK_ERRORS as exc:
+                METRICS.incr(f"{source.name}_errors")
+                last_error = exc
+                continue
+            if head is not None:
+                return head
+        if last_error is not None:
+            raise last_error
+        return None
+
+
+_default_source = None
+
+
+def default_data_source() -> DataSource:
+    """
+    根据环境变量创建（并缓存）默认数据源:
+    - LP_FEE_SNAPSHOT_DIR: 本地快照目录，设置后远程取到的快照也会写入该目录
+    - GRAPH_API_URL: 子图端点
+    - ETH_RPC_URL: 归档节点JSON-RPC端点
+    - LP_FEE_BUNDLE: 快照包路径，设置后只从快照包读取（离线重放），忽略以上数据源
+    - LP_FEE_RECORD_BUNDLE: 快照包路径，设置后记录本次运行取到的所有快照，进程退出时写出；
+      batch_runner 的工作进程各自写到 <路径>.worker<n>，由协调者合并
+
+    返回:
+    - DataSource: 组合后的数据源
+    """
+    global _default_source
+    if _default_source is None:
+        from rpc_source import RpcSource
+        from snapshot_bundle import BundleRecorder, SnapshotBundle
+
+        bundle_path = os.getenv("LP_FEE_BUNDLE")
+        if bundle_path:
+            _default_source = SnapshotBundle(bundle_path)
+            return _default_source
+
+        sources = []
+        file_source = None
+        snapshot_dir = os.getenv("LP_FEE_SNAPSHOT_DIR")
+        if snapshot_dir:
+            file_source = FileSource(snapshot_dir)
+            sources.append(file_source)
+        sources.append(SubgraphSource())
+        rpc_url = os.getenv("ETH_RPC_URL")
+        if rpc_url:
+            sources.append(RpcSource(rpc_url))
+        _default_source = DataSourceRouter(sources, write_through=file_source)
+
+        record_path = os.getenv("LP_FEE_RECORD_BUNDLE")
+        if record_path:
+            _default_source = BundleRecorder(_default_source)
+            atexit.register(_export_default_bundle, _default_source, record_path)
+    return _default_source
+
+
+def _export_default_bundle(recorder, path: str) -> None:
+    import block_resolver
+
+    # 按时间查找区块时用到的本地索引也写入快照包，离线重放时解析出相同的区块
+    resolver = block_resolver._default_resolver
+    recorder.export(path, block_index=resolver.index if resolver is not None else None)
@@ -0,0 +1,4 @@
+class DataSourceError(Exception):
+    """
+    数据源（子图、归档节点、本地文件）获取数据失败的基类
+    """
@@ -1,19 +1,27 @@
-from fee_growth_calculator import get_fee_growth_inside
-from position_updater import update_position, update_position_precise
-from GetFeeGrowth import fetch_pool_data
+from fee_growth_calculator import MAX_UINT256, get_fee_growth_inside
+from position_updater import update_position, update_position_precise, mul_div_with_precision, truncate_tokens_owed
+from data_sources import default_data_source
+from block_resolver import BlockResolver, is_block_number, resolve_blocks
+from errors import DataSourceError
+from query_planner import snapshot_tick_data
+from metrics import METRICS
+from precision import ExactAmount
 import math
 
+# Q128 = 2^128
+Q128 = 2 ** 128
 
-def convert_to_token_amount(raw_amount: float, decimals: int) -> float:
+
+def convert_to_token_amount(raw_amount, decimals: int):
     """
     将原始数量转换为实际的代币数量
     
     参数:
-    - raw_amount: 原始数量（最小单位）
+    - raw_amount: 原始数量（最小单位），int/float 或 ExactAmount
     - decimals: 代币精度
     
     返回:
-    - float: 实际代币数量
+    - float 或 ExactAmount: 实际代币数量（传入 ExactAmount 时结果仍为精确值）
     """
     return raw_amount / (10 ** decimals)
 
@@ -36,7 +44,7 @@ def tick_to_price(tick: int, decimal0: int = 18, decimal1: int = 18) -> float:
     return price
 
 
-def format_fee_display(raw_int: int, raw_precise: float, decimals: int, symbol: str) -> str:
+def format_fee_display(raw_int: int, raw_precise: ExactAmount, decimals: int, symbol: str) -> str:
     """
     格式化手续费显示
     
@@ -57,6 +65,54 @@ def format_fee_display(raw_int: int, raw_precise: float, decimals: int, symbol:
     实际{symbol}数量 - 整数: {actual_int:.{decimals}f}, 精确: {actual_precise:.{decimals+4}f}"""
 
 
+def compute_position_fees(
+    mint_snapshot,
+    current_snapshot,
+    tick_lower: int,
+    tick_upper: int,
+    liquidity: int
+):
+    """
+    根据mint区块和当前区块的快照计算头寸新产生的手续费（不打印过程信息）
+    
+    参数:
+    - mint_snapshot: mint区块的PoolSnapshot
+    - current_snapshot: 当前区块的PoolSnapshot
+    - tick_lower: 下边界tick
+    - tick_upper: 上边界tick
+    - liquidity: 流动性数量
+    
+    返回:
+    - tuple[int, ExactAmount, int, ExactAmount]: (token0整数手续费, token0精确手续费, token1整数手续费, token1精确手续费)，
+      快照中缺少边界tick数据时返回None
+    """
+    if liquidity <= 0:
+        raise ValueError("NP: 不允许对零流动性头寸进行操作")
+    
+    fee_growth_inside = []
+    for snapshot in (mint_snapshot, current_snapshot):
+        lower_outside_0, lower_outside_1, global_0, global_1, tick_current = snapshot_tick_data(snapshot, tick_lower)
+        upper_outside_0, upper_outside_1, _, _, _ = snapshot_tick_data(snapshot, tick_upper)
+        if lower_outside_0 is None or upper_outside_0 is None:
+            return None
+        with METRICS.stage("fee_growth_inside"):
+            fee_growth_inside.append(get_fee_growth_inside(
+                tick_lower=tick_lower,
+                tick_upper=tick_upper,
+                tick_current=tick_current,
+                fee_growth_global_0_x128=global_0,
+                fee_growth_global_1_x128=global_1,
+                lower_fee_growth_outside_0_x128=lower_outside_0,
+                lower_fee_growth_outside_1_x128=lower_outside_1,
+                upper_fee_growth_outside_0_x128=upper_outside_0,
+                upper_fee_growth_outside_1_x128=upper_outside_1
+            ))
+    
+    (inside_0_mint, inside_1_mint), (inside_0_current, inside_1_current) = fee_growth_inside
+    tokens_owed_0_int, tokens_owed_0_precise = truncate_tokens_owed(*mul_div_with_precision((inside_0_current - inside_0_mint) & MAX_UINT256, liquidity, Q128))
+    tokens_owed_1_int, tokens_owed_1_precise = truncate_tokens_owed(*mul_div_with_precision((inside_1_current - inside_1_mint) & MAX_UINT256, liquidity, Q128))
+    return tokens_owed_0_int, tokens_owed_0_precise, tokens_owed_1_int, tokens_owed_1_precise
+
 def calculate_lp_fees(
     pool_id: str,
     mint_block_number: str,
@@ -68,15 +124,17 @@ def calculate_lp_fees(
     token1_decimals: int,
     token0_symbol: str,
     token1_symbol: str,
-    use_fallback_data: bool = False
+    use_fallback_data: bool = False,
+    data_source=None,
+    block_resolver: BlockResolver = None
 ) -> dict:
     """
     计算LP头寸的手续费收益
     
     参数:
     - pool_id: 池子地址
-    - mint_block_number: mint时的区块号
-    - current_block_number: 当前区块号
+    - mint_block_number: mint时的区块号，也可以是时间（如 "2025-01-01"，见 block_resolver.to_timestamp）
+    - current_block_number: 当前区块号，也可以是时间（如 "now"）
     - tick_lower: 下边界tick
     - tick_upper: 上边界tick
     - liquidity: 流动性数量
@@ -85,31 +143,43 @@ def calculate_lp_fees(
     - token0_symbol: token0符号
     - token1_symbol: token1符号
     - use_fallback_data: 是否使用回退数据（当链上数据获取失败时）
+    - data_source: 数据源（见 data_sources），默认按环境变量组合本地文件、子图和归档节点
+    - block_resolver: 按时间查找区块的解析器，默认使用 data_source 创建；两者都未传入时使用 default_block_resolver()
     
     返回:
-    - dict: 包含计算结果的字典
+    - dict: 包含计算结果的字典（可直接 json.dumps）；*_precise / *_actual 为float，
+      对应的 *_exact 为精确值的十进制字符串（见 ExactAmount.__str__）
     """
     
+    if not (is_block_number(mint_block_number) and is_block_number(current_block_number)):
+        print(f"按时间查找区块: {mint_block_number} -> {current_block_number}")
+        if block_resolver is None and data_source is not None:
+            # 区块时间也从传入的数据源查询，不混用默认数据源
+            block_resolver = BlockResolver(data_source)
+    # 区块号统一转换为int，结果中的区块号字段与按时间解析出的一致
+    mint_block_number, current_block_number = resolve_blocks([mint_block_number, current_block_number], block_resolver)
+    
     print("=== 从链上获取数据 ===")
     print(f"Pool ID: {pool_id}")
     print(f"Mint区块号: {mint_block_number} (更早的区块)")
     print(f"当前区块号: {current_block_number}")
     print(f"查询Tick范围: [{tick_lower}, {tick_upper}]")
     
-    # 第一步：从链上获取mint区块的lower tick数据
-    print(f"\n第一步：获取mint区块({mint_block_number})的下边界tick数据")
-    lower_fee_growth_outside_0_x128_mint, lower_fee_growth_outside_1_x128_mint, fee_growth_global_0_x128_mint, fee_growth_global_1_x128_mint, tick_current_mint = fetch_pool_data(pool_id, mint_block_number, tick_lower)
-    
-    # 第二步：获取mint区块的上边界tick数据
-    print(f"\n第二步：获取mint区块({mint_block_number})的上边界tick数据")
-    upper_fee_growth_outside_0_x128_mint, upper_fee_growth_outside_1_x128_mint, _, _, _ = fetch_pool_data(pool_id, mint_block_number, tick_upper)
-    
-    # 第三步：获取当前区块的数据
-    print(f"\n第三步：获取当前区块({current_block_number})的下边界tick数据")
-    lower_fee_growth_outside_0_x128, lower_fee_growth_outside_1_x128, fee_growth_global_0_x128, fee_growth_global_1_x128, tick_current = fetch_pool_data(pool_id, current_block_number, tick_lower)
-    
-    print(f"\n第四步：获取当前区块({current_block_number})的上边界tick数据")
-    upper_fee_growth_outside_0_x128, upper_fee_growth_outside_1_x128, _, _, _ = fetch_pool_data(pool_id, current_block_number, tick_upper)
+    # 第一步：一次批量请求获取mint区块和当前区块的上下边界tick数据
+    print(f"\n第一步：批量获取mint区块({mint_block_number})和当前区块({current_block_number})的边界tick数据")
+    source = data_source if data_source is not None else default_data_source()
+    try:
+        snapshots = source.get_snapshots(pool_id, [mint_block_number, current_block_number], [tick_lower, tick_upper])
+    except DataSourceError as exc:
+        print(f"数据源请求失败：{exc}")
+        snapshots = {}
+    mint_snapshot = snapshots.get(mint_block_number)
+    current_snapshot = snapshots.get(current_block_number)
+    
+    lower_fee_growth_outside_0_x128_mint, lower_fee_growth_outside_1_x128_mint, fee_growth_global_0_x128_mint, fee_growth_global_1_x128_mint, tick_current_mint = snapshot_tick_data(mint_snapshot, tick_lower)
+    upper_fee_growth_outside_0_x128_mint, upper_fee_growth_outside_1_x128_mint, _, _, _ = snapshot_tick_data(mint_snapshot, tick_upper)
+    lower_fee_growth_outside_0_x128, lower_fee_growth_outside_1_x128, fee_growth_global_0_x128, fee_growth_global_1_x128, tick_current = snapshot_tick_data(current_snapshot, tick_lower)
+    upper_fee_growth_outside_0_x128, upper_fee_growth_outside_1_x128, _, _, _ = snapshot_tick_data(current_snapshot, tick_upper)
     
     # 检查数据获取是否成功或使用回退数据
     if (use_fallback_data or 
@@ -146,63 +216,67 @@ def calculate_lp_fees(
         print(f"当前区块全局Fee Growth 1: {fee_growth_global_1_x128}")
         print(f"当前Tick: {tick_current}")
     
-    # 第五步：计算mint区块的区间内手续费增长
-    print("\n第五步：计算mint区块的区间内手续费增长")
+    # 第二步：计算mint区块的区间内手续费增长
+    print("\n第二步：计算mint区块的区间内手续费增长")
     
     # 调用手续费增长计算函数（mint区块）
-    fee_growth_inside_0_x128_mint, fee_growth_inside_1_x128_mint = get_fee_growth_inside(
-        tick_lower=tick_lower,
-        tick_upper=tick_upper,
-        tick_current=tick_current_mint,
-        fee_growth_global_0_x128=fee_growth_global_0_x128_mint,
-        fee_growth_global_1_x128=fee_growth_global_1_x128_mint,
-        lower_fee_growth_outside_0_x128=lower_fee_growth_outside_0_x128_mint,
-        lower_fee_growth_outside_1_x128=lower_fee_growth_outside_1_x128_mint,
-        upper_fee_growth_outside_0_x128=upper_fee_growth_outside_0_x128_mint,
-        upper_fee_growth_outside_1_x128=upper_fee_growth_outside_1_x128_mint
-    )
+    with METRICS.stage("fee_growth_inside"):
+        fee_growth_inside_0_x128_mint, fee_growth_inside_1_x128_mint = get_fee_growth_inside(
+            tick_lower=tick_lower,
+            tick_upper=tick_upper,
+            tick_current=tick_current_mint,
+            fee_growth_global_0_x128=fee_growth_global_0_x128_mint,
+            fee_growth_global_1_x128=fee_growth_global_1_x128_mint,
+            lower_fee_growth_outside_0_x128=lower_fee_growth_outside_0_x128_mint,
+            lower_fee_growth_outside_1_x128=lower_fee_growth_outside_1_x128_mint,
+            upper_fee_growth_outside_0_x128=upper_fee_growth_outside_0_x128_mint,
+            upper_fee_growth_outside_1_x128=upper_fee_growth_outside_1_x128_mint
+        )
     
     print(f"Mint区块区间内token0手续费增长: {fee_growth_inside_0_x128_mint}")
     print(f"Mint区块区间内token1手续费增长: {fee_growth_inside_1_x128_mint}")
     
-    # 第六步：计算当前区块的区间内手续费增长
-    print("\n第六步：计算当前区块的区间内手续费增长")
+    # 第三步：计算当前区块的区间内手续费增长
+    print("\n第三步：计算当前区块的区间内手续费增长")
     
     # 调用手续费增长计算函数（当前区块）
-    fee_growth_inside_0_x128_current, fee_growth_inside_1_x128_current = get_fee_growth_inside(
-        tick_lower=tick_lower,
-        tick_upper=tick_upper,
-        tick_current=tick_current,
-        fee_growth_global_0_x128=fee_growth_global_0_x128,
-        fee_growth_global_1_x128=fee_growth_global_1_x128,
-        lower_fee_growth_outside_0_x128=lower_fee_growth_outside_0_x128,
-        lower_fee_growth_outside_1_x128=lower_fee_growth_outside_1_x128,
-        upper_fee_growth_outside_0_x128=upper_fee_growth_outside_0_x128,
-        upper_fee_growth_outside_1_x128=upper_fee_growth_outside_1_x128
-    )
+    with METRICS.stage("fee_growth_inside"):
+        fee_growth_inside_0_x128_current, fee_growth_inside_1_x128_current = get_fee_growth_inside(
+            tick_lower=tick_lower,
+            tick_upper=tick_upper,
+            tick_current=tick_current,
+            fee_growth_global_0_x128=fee_growth_global_0_x128,
+            fee_growth_global_1_x128=fee_growth_global_1_x128,
+            lower_fee_growth_outside_0_x128=lower_fee_growth_outside_0_x128,
+            lower_fee_growth_outside_1_x128=lower_fee_growth_outside_1_x128,
+            upper_fee_growth_outside_0_x128=upper_fee_growth_outside_0_x128,
+            upper_fee_growth_outside_1_x128=upper_fee_growth_outside_1_x128
+        )
     
     print(f"当前区块区间内token0手续费增长: {fee_growth_inside_0_x128_current}")
     print(f"当前区块区间内token1手续费增长: {fee_growth_inside_1_x128_current}")
     
-    # 第七步：更新头寸并计算新产生的手续费
-    print("\n第七步：更新头寸并计算新产生的手续费")
+    # 第四步：更新头寸并计算新产生的手续费
+    print("\n第四步：更新头寸并计算新产生的手续费")
     
     # 使用mint区块的手续费增长作为起始值（上次记录的值）
     fee_growth_inside_0_last_x128 = fee_growth_inside_0_x128_mint
     fee_growth_inside_1_last_x128 = fee_growth_inside_1_x128_mint
     
     # 调用update_position_precise函数，计算从mint区块到当前区块之间的手续费变化（包含精确小数）
-    tokens_owed_0_int, tokens_owed_0_precise, tokens_owed_1_int, tokens_owed_1_precise = update_position_precise(
-        liquidity=liquidity,
-        fee_growth_inside_0_x128=fee_growth_inside_0_x128_current,  # 使用当前区块的值
-        fee_growth_inside_1_x128=fee_growth_inside_1_x128_current,  # 使用当前区块的值
-        fee_growth_inside_0_last_x128=fee_growth_inside_0_last_x128,  # 使用mint区块的值
-        fee_growth_inside_1_last_x128=fee_growth_inside_1_last_x128   # 使用mint区块的值
-    )
+    with METRICS.stage("update_position"):
+        tokens_owed_0_int, tokens_owed_0_precise, tokens_owed_1_int, tokens_owed_1_precise = update_position_precise(
+            liquidity=liquidity,
+            fee_growth_inside_0_x128=fee_growth_inside_0_x128_current,  # 使用当前区块的值
+            fee_growth_inside_1_x128=fee_growth_inside_1_x128_current,  # 使用当前区块的值
+            fee_growth_inside_0_last_x128=fee_growth_inside_0_last_x128,  # 使用mint区块的值
+            fee_growth_inside_1_last_x128=fee_growth_inside_1_last_x128   # 使用mint区块的值
+        )
     
     print(f"\n=== 手续费详细信息 ===")
-    print(f"Token0 ({token0_symbol})手续费:{format_fee_display(tokens_owed_0_int, tokens_owed_0_precise, token0_decimals, token0_symbol)}")
-    print(f"\nToken1 ({token1_symbol})手续费:{format_fee_display(tokens_owed_1_int, tokens_owed_1_precise, token1_decimals, token1_symbol)}")
+    with METRICS.stage("format"):
+        print(f"Token0 ({token0_symbol})手续费:{format_fee_display(tokens_owed_0_int, tokens_owed_0_precise, token0_decimals, token0_symbol)}")
+        print(f"\nToken1 ({token1_symbol})手续费:{format_fee_display(tokens_owed_1_int, tokens_owed_1_precise, token1_decimals, token1_symbol)}")
     
     # 计算总价值
     token0_actual = convert_to_token_amount(tokens_owed_0_precise, token0_decimals)
@@ -244,30 +318,35 @@ def calculate_lp_fees(
     print(f"  {token1_symbol}: {token1_actual:.{token1_decimals+2}f} (原始: {tokens_owed_1_precise:.10f})")
     
     # 返回结果
-    return {
-        "pool_id": pool_id,
-        "mint_block_number": mint_block_number,
-        "current_block_number": current_block_number,
-        "tick_lower": tick_lower,
-        "tick_upper": tick_upper,
-        "tick_current_mint": tick_current_mint,
-        "tick_current": tick_current,
-        "liquidity": liquidity,
-        "fee_growth_inside_0_x128_mint": fee_growth_inside_0_x128_mint,
-        "fee_growth_inside_1_x128_mint": fee_growth_inside_1_x128_mint,
-        "fee_growth_inside_0_x128_current": fee_growth_inside_0_x128_current,
-        "fee_growth_inside_1_x128_current": fee_growth_inside_1_x128_current,
-        "tokens_owed_0_int": tokens_owed_0_int,
-        "tokens_owed_0_precise": tokens_owed_0_precise,
-        "tokens_owed_1_int": tokens_owed_1_int,
-        "tokens_owed_1_precise": tokens_owed_1_precise,
-        "token0_actual": token0_actual,
-        "token1_actual": token1_actual,
-        "token0_symbol": token0_symbol,
-        "token1_symbol": token1_symbol,
-        "token0_decimals": token0_decimals,
-        "token1_decimals": token1_decimals
-    }
+    with METRICS.stage("assemble"):
+        return {
+            "pool_id": pool_id,
+            "mint_block_number": mint_block_number,
+            "current_block_number": current_block_number,
+            "tick_lower": tick_lower,
+            "tick_upper": tick_upper,
+            "tick_current_mint": tick_current_mint,
+            "tick_current": tick_current,
+            "liquidity": liquidity,
+            "fee_growth_inside_0_x128_mint": fee_growth_inside_0_x128_mint,
+            "fee_growth_inside_1_x128_mint": fee_growth_inside_1_x128_mint,
+            "fee_growth_inside_0_x128_current": fee_growth_inside_0_x128_current,
+            "fee_growth_inside_1_x128_current": fee_growth_inside_1_x128_current,
+            "tokens_owed_0_int": tokens_owed_0_int,
+            "tokens_owed_0_precise": float(tokens_owed_0_precise),
+            "tokens_owed_0_exact": str(tokens_owed_0_precise),
+            "tokens_owed_1_int": tokens_owed_1_int,
+            "tokens_owed_1_precise": float(tokens_owed_1_precise),
+            "tokens_owed_1_exact": str(tokens_owed_1_precise),
+            "token0_actual": float(token0_actual),
+            "token0_actual_exact": str(token0_actual),
+            "token1_actual": float(token1_actual),
+            "token1_actual_exact": str(token1_actual),
+            "token0_symbol": token0_symbol,
+            "token1_symbol": token1_symbol,
+            "token0_decimals": token0_decimals,
+            "token1_decimals": token1_decimals
+        }
 
 
 # ===== 示例使用方式 =====
@@ -310,8 +389,13 @@ def example_usage():
     print(f"\n=== 函数返回结果 ===")
     print(f"获得的{result['token0_symbol']}: {result['token0_actual']:.{result['token0_decimals']+2}f}")
     print(f"获得的{result['token1_symbol']}: {result['token1_actual']:.{result['token1_decimals']+2}f}")
-    print(f"原始精确值 - {result['token0_symbol']}: {result['tokens_owed_0_precise']:.10f}")
-    print(f"原始精确值 - {result['token1_symbol']}: {result['tokens_owed_1_precise']:.10f}")
+    print(f"原始精确值 - {result['token0_symbol']}: {result['tokens_owed_0_exact']}")
+    print(f"原始精确值 - {result['token1_symbol']}: {result['tokens_owed_1_exact']}")
+    
+    # 开启埋点时（LP_FEE_METRICS=1）输出各阶段耗时与计数
+    if METRICS.enabled:
+        print(f"\n=== 性能埋点 ===")
+        print(METRICS.to_prometheus())
     
     return result
 
@@ -1,3 +1,7 @@
+# 合约中的手续费增长是uint256，减法按 2^256 取模（tick外侧增长可以大于全局增长，结果会回绕）
+MAX_UINT256 = 2 ** 256 - 1
+
+
 def get_fee_growth_inside(
     tick_lower: int,
     tick_upper: int,
@@ -24,7 +28,7 @@ def get_fee_growth_inside(
     - upper_fee_growth_outside_1_x128: 上边界外token1手续费增长
     
     返回:
-    - tuple[int, int]: (区间内token0手续费增长, 区间内token1手续费增长)
+    - tuple[int, int]: (区间内token0手续费增长, 区间内token1手续费增长)，按 2^256 取模
     """
     
     # 计算下方手续费增长
@@ -44,8 +48,8 @@ def get_fee_growth_inside(
         fee_growth_above_1_x128 = fee_growth_global_1_x128 - upper_fee_growth_outside_1_x128
 
     # 计算区间内手续费增长
-    fee_growth_inside_0_x128 = fee_growth_global_0_x128 - fee_growth_below_0_x128 - fee_growth_above_0_x128
-    fee_growth_inside_1_x128 = fee_growth_global_1_x128 - fee_growth_below_1_x128 - fee_growth_above_1_x128
+    fee_growth_inside_0_x128 = (fee_growth_global_0_x128 - fee_growth_below_0_x128 - fee_growth_above_0_x128) & MAX_UINT256
+    fee_growth_inside_1_x128 = (fee_growth_global_1_x128 - fee_growth_below_1_x128 - fee_growth_above_1_x128) & MAX_UINT256
 
     return fee_growth_inside_0_x128, fee_growth_inside_1_x128
 
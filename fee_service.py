@@ -0,0 +1,316 @@
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import msgpack
+except ImportError:  # msgpack 为可选依赖，未安装时只提供JSON
+    msgpack = None
+
+from fee_calculator import compute_position_fees
+from metrics import METRICS
+from snapshot_cache import FINALITY_CONFIRMATIONS, SnapshotCache
+from data_sources import default_data_source
+from errors import DataSourceError
+from block_resolver import HEAD_TTL, BlockResolver, default_block_resolver, is_block_number
+
+# 已完成的报价缓存条数上限
+RESPONSE_CACHE_SIZE = 10_000
+# 代币精度上限：10 ** 77 < 2 ** 256 < 10 ** 78
+MAX_DECIMALS = 77
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+_REQUIRED_FIELDS = ("pool_id", "mint_block_number", "current_block_number", "tick_lower", "tick_upper", "liquidity")
+_BLOCK_FIELDS = ("mint_block_number", "current_block_number")
+
+
+class QuoteError(Exception):
+    """
+    报价失败，status 为对应的HTTP状态码
+    """
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_quote_request(params: dict) -> tuple:
+    """
+    校验并规范化报价请求
+
+    参数:
+    - params: 请求参数，必填 pool_id, mint_block_number, current_block_number, tick_lower, tick_upper, liquidity，
+      可选 token0_decimals, token1_decimals（默认18，范围 0 ~ MAX_DECIMALS）
+
+    返回:
+    - tuple: 规范化后的参数，同时用作响应缓存的键
+    """
+    if not isinstance(params, dict):
+        raise QuoteError("请求体必须是对象或对象数组")
+    missing = [field for field in _REQUIRED_FIELDS if field not in params]
+    if missing:
+        raise QuoteError(f"缺少参数: {', '.join(missing)}")
+    try:
+        key = (
+            str(params["pool_id"]).lower(),
+            int(params["mint_block_number"]),
+            int(params["current_block_number"]),
+            int(params["tick_lower"]),
+            int(params["tick_upper"]),
+            int(params["liquidity"]),
+            int(params.get("token0_decimals", 18)),
+            int(params.get("token1_decimals", 18)),
+        )
+    except (TypeError, ValueError) as exc:
+        raise QuoteError(f"参数格式错误: {exc}")
+    if key[1] > key[2]:
+        raise QuoteError("mint_block_number 不能晚于 current_block_number")
+    if key[3] >= key[4]:
+        raise QuoteError("tick_lower 必须小于 tick_upper")
+    if key[5] <= 0:
+        raise QuoteError("NP: 不允许对零流动性头寸进行操作")
+    if not (0 <= key[6] <= MAX_DECIMALS and 0 <= key[7] <= MAX_DECIMALS):
+        raise QuoteError(f"token0_decimals / token1_decimals 必须在 0 ~ {MAX_DECIMALS} 之间")
+    return key
+
+
+class FeeQuoteService:
+    """
+    手续费报价服务：并发请求共享快照获取，已完成的报价按参数缓存
+
+    只有距最新区块至少 confirmations 个确认的区块才进入快照缓存和报价缓存；
+    更新的区块（包括 "now" 解析出的最新区块）可能被重组，每次都重新计算。
+    没有配置 ETH_RPC_URL 时以子图已索引到的区块作为最新区块；无法获取最新区块时不缓存任何结果
+    """
+
+    def __init__(
+        self,
+        snapshot_cache: SnapshotCache = None,
+        response_cache_size: int = RESPONSE_CACHE_SIZE,
+        block_resolver: BlockResolver = None,
+        confirmations: int = FINALITY_CONFIRMATIONS
+    ):
+        self.block_resolver = block_resolver
+        self.confirmations = confirmations
+        # SnapshotCache 定义了 __len__，空缓存为假值，不能用 or 判断
+        if snapshot_cache is None:
+            snapshot_cache = SnapshotCache(fetch=default_data_source().get_snapshots, finalized_block=self.finalized_block)
+        self.snapshots = snapshot_cache
+        self.response_cache_size = response_cache_size
+        self._responses: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._head_error_time = None
+
+    def finalized_block(self) -> int:
+        """
+        返回:
+        - int: 距最新区块至少 confirmations 个确认的最高区块号；无法获取最新区块时为-1（不视任何区块为已确定）
+        """
+        # 获取最新区块失败后 HEAD_TTL 秒内不再重试，避免每个请求都等一次失败的查询
+        if self._head_error_time is not None and time.monotonic() - self._head_error_time < HEAD_TTL:
+            return -1
+        try:
+            head = (self.block_resolver or default_block_resolver()).latest_block()
+        except DataSourceError:
+            head = None
+        if head is None:
+            self._head_error_time = time.monotonic()
+            return -1
+        self._head_error_time = None
+        return head - self.confirmations
+
+    def _resolve_block_times(self, params: dict) -> dict:
+        # mint_block_number / current_block_number 可以是时间（如 "2025-01-01"、"now"），先换算为区块号
+        if not isinstance(params, dict):
+            return params
+        fields = [field for field in _BLOCK_FIELDS if field in params and not is_block_number(params[field])]
+        if not fields:
+            return params
+        resolver = self.block_resolver or default_block_resolver()
+        try:
+            blocks = resolver.blocks_at([params[field] for field in fields])
+        except ValueError as exc:
+            raise QuoteError(f"参数格式错误: {exc}")
+        except DataSourceError as exc:
+            raise QuoteError(f"按时间查找区块失败: {exc}", status=502)
+        return {**params, **dict(zip(fields, blocks))}
+
+    def quote(self, params: dict) -> dict:
+        """
+        计算单个头寸的手续费报价
+
+        参数:
+        - params: 见 parse_quote_request，区块号字段也可以是时间（见 block_resolver.to_timestamp）
+
+        返回:
+        - dict: 可直接序列化的结果，256位整数以字符串表示
+        """
+        key = parse_quote_request(self._resolve_block_times(params))
+        # mint_block_number 不晚于 current_block_number，只需检查后者
+        cacheable = key[2] <= self.finalized_block()
+        if cacheable:
+            with self._lock:
+                cached = self._responses.get(key)
+                if cached is not None:
+                    self._responses.move_to_end(key)
+                    METRICS.incr("response_cache_hits")
+                    return cached
+
+        pool_id, mint_block, current_block, tick_lower, tick_upper, liquidity, token0_decimals, token1_decimals = key
+        try:
+            snapshots = self.snapshots.get(pool_id, [mint_block, current_block], [tick_lower, tick_upper])
+        except DataSourceError as exc:
+            raise QuoteError(f"数据源请求失败: {exc}", status=502)
+        mint_snapshot = snapshots.get(mint_block)
+        current_snapshot = snapshots.get(current_block)
+        fees = compute_position_fees(mint_snapshot, current_snapshot, tick_lower, tick_upper, liquidity)
+        if fees is None:
+            raise QuoteError("无法从数据源获取该区块的tick数据", status=502)
+
+        with METRICS.stage("assemble"):
+            tokens_owed_0_int, tokens_owed_0_precise, tokens_owed_1_int, tokens_owed_1_precise = fees
+            response = {
+                "pool_id": pool_id,
+                "mint_block_number": mint_block,
+                "current_block_number": current_block,
+                "tick_lower": tick_lower,
+                "tick_upper": tick_upper,
+                "tick_current_mint": mint_snapshot.tick_current,
+                "tick_current": current_snapshot.tick_current,
+                "liquidity": str(liquidity),
+                "tokens_owed_0": str(tokens_owed_0_int),
+                "tokens_owed_1": str(tokens_owed_1_int),
+                "token0_amount": f"{tokens_owed_0_precise / (10 ** token0_decimals):.{token0_decimals + 4}f}",
+                "token1_amount": f"{tokens_owed_1_precise / (10 ** token1_decimals):.{token1_decimals + 4}f}",
+            }
+
+        if cacheable:
+            with self._lock:
+                self._responses[key] = response
+                while len(self._responses) > self.response_cache_size:
+                    self._responses.popitem(last=False)
+        return response
+
+
+def encode_response(payload, content_type: str) -> bytes:
+    """
+    按内容类型序列化响应
+
+    参数:
+    - payload: 可序列化对象
+    - content_type: JSON_CONTENT_TYPE 或 MSGPACK_CONTENT_TYPE
+
+    返回:
+    - bytes: 响应体
+    """
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FeeQuoteHandler(BaseHTTPRequestHandler):
+    """
+    POST /quote  请求体为单个对象或对象数组（JSON或msgpack）
+    GET  /metrics  Prometheus格式的埋点数据
+    GET  /healthz  健康检查
+    """
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，关闭Nagle避免与客户端的延迟ACK叠加出40ms延迟
+    disable_nagle_algorithm = True
+    service: FeeQuoteService = None
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _response_type(self) -> str:
+        if msgpack is not None and MSGPACK_CONTENT_TYPE in self.headers.get("Accept", ""):
+            return MSGPACK_CONTENT_TYPE
+        return JSON_CONTENT_TYPE
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            self._send(200, b"ok", "text/plain")
+        elif self.path == "/metrics":
+            self._send(200, METRICS.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send(404, encode_response({"error": "not found"}, JSON_CONTENT_TYPE), JSON_CONTENT_TYPE)
+
+    def do_POST(self):
+        content_type = self._response_type()
+        if self.path != "/quote":
+            self._send(404, encode_response({"error": "not found"}, content_type), content_type)
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Type", "").startswith(MSGPACK_CONTENT_TYPE):
+                if msgpack is None:
+                    raise QuoteError("服务端未安装msgpack", status=415)
+                params = msgpack.unpackb(body, raw=False)
+            else:
+                params = json.loads(body or b"null")
+        except QuoteError as exc:
+            self._send(exc.status, encode_response({"error": str(exc)}, JSON_CONTENT_TYPE), JSON_CONTENT_TYPE)
+            return
+        except Exception:
+            self._send(400, encode_response({"error": "请求体无法解析"}, content_type), content_type)
+            return
+
+        try:
+            if isinstance(params, list):
+                payload = [self.service.quote(item) for item in params]
+            else:
+                payload = self.service.quote(params)
+            status = 200
+        except QuoteError as exc:
+            payload, status = {"error": str(exc)}, exc.status
+        except Exception as exc:
+            # 未预料的错误也返回JSON错误响应，而不是让连接直接断开
+            METRICS.incr("quote_errors")
+            payload, status = {"error": f"服务内部错误: {type(exc).__name__}"}, 500
+        self._send(status, encode_response(payload, content_type), content_type)
+
+    def log_message(self, format, *args):
+        # 压测时逐条打印请求日志的开销很大，默认关闭
+        pass
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8000, service: FeeQuoteService = None) -> ThreadingHTTPServer:
+    """
+    创建报价服务（未启动）
+
+    参数:
+    - host: 监听地址
+    - port: 监听端口，0表示随机端口
+    - service: FeeQuoteService 实例，默认新建
+
+    返回:
+    - ThreadingHTTPServer: 调用 serve_forever() 启动
+    """
+    handler = type("BoundFeeQuoteHandler", (FeeQuoteHandler,), {"service": service or FeeQuoteService()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LP手续费报价服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port)
+    print(f"手续费报价服务已启动: http://{args.host}:{args.port}/quote")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,416 @@
+import argparse
+import contextlib
+import random
+import sys
+import time
+from collections import Counter
+
+from analytics import Position, analyze_pool
+from fee_calculator import Q128, compute_position_fees
+from fee_growth_calculator import get_fee_growth_inside
+from position_updater import (
+    mul_div,
+    mul_div_with_precision,
+    mul_div_with_remainder,
+    update_position,
+    update_position_precise,
+)
+from query_planner import PoolSnapshot
+
+# 手续费计算的确定性差分测试：按随机种子生成池子状态，覆盖 get_fee_growth_inside 的所有分支、
+# uint256回绕和手续费的uint128截断，把各个实现（标量函数、update_position / update_position_precise、compute_position_fees、
+# analyze_pool 的批量路径）与下面独立写出的参考实现逐一比较。任何不一致都以非零状态码退出，可作为性能优化的回归门禁。
+
+MIN_TICK = -887272
+MAX_TICK = 887272
+MAX_UINT128 = 2 ** 128 - 1
+# 参考实现自己定义uint128/uint256的取模，不依赖被测模块
+MAX_UINT256 = 2 ** 256 - 1
+MODULUS = MAX_UINT256 + 1
+
+CHUNK_SIZE = 10_000      # 每个分块的用例数，每个分块有独立的随机数生成器，可以单独重放
+SLOW_EVERY = 16          # 会打印过程信息的函数（update_position、mul_div等）每隔多少个用例检查一次
+BATCH_POSITIONS = 64     # 批量路径每批的头寸数
+BATCH_EVERY = 1_000      # 每隔多少个用例检查一批
+MAX_FAILURES = 20        # 每个分块最多记录的失败用例数
+
+# tick_current 相对区间边界的位置，对应 get_fee_growth_inside 的分支及边界取值
+BRANCHES = ("below", "at_lower", "inside", "below_upper", "at_upper", "above")
+
+
+class _NullWriter:
+    """
+    丢弃输出，用于屏蔽被测函数中的调试打印
+    """
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def reference_fee_growth_inside(tick_lower: int, tick_upper: int, tick_current: int, fee_growth_global: int, lower_outside: int, upper_outside: int) -> int:
+    """
+    参考实现：按 tick_current 所在区域直接写出化简后的公式（与合约 Tick.getFeeGrowthInside 等价），按 2^256 取模
+    """
+    if tick_current < tick_lower:
+        return (lower_outside - upper_outside) % MODULUS
+    if tick_current < tick_upper:
+        return (fee_growth_global - lower_outside - upper_outside) % MODULUS
+    return (upper_outside - lower_outside) % MODULUS
+
+
+def reference_tokens_owed(inside: int, inside_last: int, liquidity: int) -> int:
+    """
+    参考实现：返回精确手续费的分子（分母为Q128），与合约 Position.update 一致，增长差值按 2^256 取模；
+    手续费的整数部分按uint128截断、小数部分不变，等价于分子按 2^128 * Q128 = 2^256 取模
+    """
+    return ((inside - inside_last) % MODULUS) * liquidity % MODULUS
+
+
+def _below(rng: random.Random, n: int) -> int:
+    # [0, n) 内的随机整数；比 randrange 快得多，多取8位使取模带来的偏差可以忽略
+    return rng.getrandbits(n.bit_length() + 8) % n
+
+
+def _fee_growth(rng: random.Random, kind: int) -> int:
+    # kind 取 0~7：零、小值、中间值、接近上限（配合增量产生回绕）、任意256位
+    if kind == 0:
+        return 0
+    if kind == 1:
+        return rng.getrandbits(64)
+    if kind == 2:
+        return rng.getrandbits(128) << 64
+    if kind == 3:
+        return MAX_UINT256 - rng.getrandbits(64)
+    return rng.getrandbits(256)
+
+
+def _liquidity(rng: random.Random) -> int:
+    kind = rng.getrandbits(3)
+    if kind == 0:
+        return 1
+    if kind == 1:
+        return MAX_UINT128
+    return rng.getrandbits(1 + _below(rng, 128)) or 1
+
+
+def _tick_current(rng: random.Random, branch: int, tick_lower: int, tick_upper: int) -> int:
+    if branch == 0:
+        return MIN_TICK + _below(rng, tick_lower - MIN_TICK)
+    if branch == 1:
+        return tick_lower
+    if branch == 2:
+        return tick_lower + _below(rng, tick_upper - tick_lower)
+    if branch == 3:
+        return tick_upper - 1
+    if branch == 4:
+        return tick_upper
+    return tick_upper + 1 + _below(rng, MAX_TICK - tick_upper)
+
+
+def _state(rng: random.Random, branch: int, tick_lower: int, tick_upper: int) -> tuple:
+    # (tick_current, 全局0, 全局1, 下边界外侧0, 下边界外侧1, 上边界外侧0, 上边界外侧1)
+    tick_current = _tick_current(rng, branch, tick_lower, tick_upper)
+    kinds = rng.getrandbits(18)
+    if kinds & 1:
+        # 与真实池子一致的状态：外侧增长不超过全局增长，参考公式中不发生回绕
+        global_0, global_1 = _fee_growth(rng, kinds >> 1 & 7), _fee_growth(rng, kinds >> 4 & 7)
+        lower_0, upper_0 = sorted((_below(rng, global_0 + 1), _below(rng, global_0 + 1)))
+        lower_1, upper_1 = sorted((_below(rng, global_1 + 1), _below(rng, global_1 + 1)))
+        if tick_current < tick_lower:
+            lower_0, upper_0, lower_1, upper_1 = upper_0, lower_0, upper_1, lower_1
+        elif tick_current < tick_upper:
+            upper_0, upper_1 = _below(rng, global_0 - lower_0 + 1), _below(rng, global_1 - lower_1 + 1)
+        return tick_current, global_0, global_1, lower_0, lower_1, upper_0, upper_1
+    return (tick_current,) + tuple(_fee_growth(rng, kinds >> shift & 7) for shift in (1, 4, 7, 10, 13, 16))
+
+
+def _grow(rng: random.Random, state: tuple, branch: int, tick_lower: int, tick_upper: int) -> tuple:
+    # 在前一个状态上叠加增量（按 2^256 取模），模拟真实的 mint -> 当前 演变
+    return (_tick_current(rng, branch, tick_lower, tick_upper),) + tuple(
+        (value + rng.getrandbits(32 + 64 * _below(rng, 3))) & MAX_UINT256 for value in state[1:]
+    )
+
+
+def _truncation_case(rng: random.Random) -> tuple:
+    # 手续费整数部分恰好在 2^128 的整数倍附近：区间内增长差值取 ceil(目标 * Q128 / 流动性)，
+    # 两个区块的tick都在区间内、边界外侧增长为0，区间内增长即全局增长
+    liquidity = _liquidity(rng)
+    target = (1 + _below(rng, 3)) << 128
+    target += rng.getrandbits(32) - (1 << 31)
+    diff_0 = min(-(-target * Q128 // liquidity), MAX_UINT256)
+    diff_1 = min(-(-(target + rng.getrandbits(8)) * Q128 // liquidity), MAX_UINT256)
+    tick_lower = MIN_TICK + 1 + _below(rng, MAX_TICK - MIN_TICK - 2)
+    tick_upper = tick_lower + 1 + _below(rng, MAX_TICK - 1 - tick_lower)
+    mint_0, mint_1 = rng.getrandbits(256), rng.getrandbits(256)
+    branch = BRANCHES.index("inside")
+    mint = (_tick_current(rng, branch, tick_lower, tick_upper), mint_0, mint_1, 0, 0, 0, 0)
+    current = (_tick_current(rng, branch, tick_lower, tick_upper), (mint_0 + diff_0) & MAX_UINT256, (mint_1 + diff_1) & MAX_UINT256, 0, 0, 0, 0)
+    return tick_lower, tick_upper, liquidity, branch, mint, branch, current
+
+
+def generate_case(rng: random.Random) -> tuple:
+    """
+    生成一个用例
+
+    返回:
+    - tuple: (tick_lower, tick_upper, liquidity, mint分支, mint状态, 当前分支, 当前状态)，
+      分支为 BRANCHES 中的下标，状态为 (tick_current, 全局0, 全局1, 下边界外侧0, 下边界外侧1, 上边界外侧0, 上边界外侧1)
+    """
+    choices = rng.getrandbits(16)
+    if choices & 31 == 31:
+        return _truncation_case(rng)
+    tick_lower = MIN_TICK + 1 + _below(rng, MAX_TICK - MIN_TICK - 2)
+    if choices & 3:
+        tick_upper = tick_lower + 1 + _below(rng, MAX_TICK - 1 - tick_lower)
+    else:
+        # 窄区间：下一个tick就是上边界
+        tick_upper = tick_lower + 1
+    mint_branch = (choices >> 2 & 255) % len(BRANCHES)
+    current_branch = (choices >> 10) % len(BRANCHES)
+    mint = _state(rng, mint_branch, tick_lower, tick_upper)
+    if choices >> 9 & 1:
+        current = _grow(rng, mint, current_branch, tick_lower, tick_upper)
+    else:
+        current = _state(rng, current_branch, tick_lower, tick_upper)
+    return tick_lower, tick_upper, _liquidity(rng), mint_branch, mint, current_branch, current
+
+
+def _wraps(tick_lower: int, tick_upper: int, state: tuple) -> bool:
+    # 参考公式中的减法是否发生了回绕
+    tick_current, global_0, global_1, lower_0, lower_1, upper_0, upper_1 = state
+    for global_, lower, upper in ((global_0, lower_0, upper_0), (global_1, lower_1, upper_1)):
+        if tick_current < tick_lower:
+            raw = lower - upper
+        elif tick_current < tick_upper:
+            raw = global_ - lower - upper
+        else:
+            raw = upper - lower
+        if raw < 0:
+            return True
+    return False
+
+
+def _truncates(case: tuple) -> bool:
+    # 任一token的手续费整数部分是否超过uint128（被截断）
+    tick_lower, tick_upper, liquidity, _, mint, _, current = case
+    for k in (0, 1):
+        inside_mint = reference_fee_growth_inside(tick_lower, tick_upper, mint[0], mint[1 + k], mint[3 + k], mint[5 + k])
+        inside_current = reference_fee_growth_inside(tick_lower, tick_upper, current[0], current[1 + k], current[3 + k], current[5 + k])
+        if ((inside_current - inside_mint) % MODULUS) * liquidity // Q128 > MAX_UINT128:
+            return True
+    return False
+
+
+def check_case(case: tuple, slow: bool) -> list[str]:
+    """
+    用一个用例比较所有标量实现与参考实现
+
+    参数:
+    - case: generate_case 的返回值
+    - slow: 是否同时检查会打印过程信息的函数
+
+    返回:
+    - list[str]: 不一致的检查项名称
+    """
+    tick_lower, tick_upper, liquidity, _, mint, _, current = case
+    failures = []
+
+    inside = []
+    for name, state in (("mint", mint), ("current", current)):
+        tick_current, global_0, global_1, lower_0, lower_1, upper_0, upper_1 = state
+        expected = (
+            reference_fee_growth_inside(tick_lower, tick_upper, tick_current, global_0, lower_0, upper_0),
+            reference_fee_growth_inside(tick_lower, tick_upper, tick_current, global_1, lower_1, upper_1),
+        )
+        actual = get_fee_growth_inside(tick_lower, tick_upper, tick_current, global_0, global_1, lower_0, lower_1, upper_0, upper_1)
+        if actual != expected:
+            failures.append(f"get_fee_growth_inside[{name}]")
+        inside.append(expected)
+    (inside_0_mint, inside_1_mint), (inside_0_current, inside_1_current) = inside
+
+    owed_0 = reference_tokens_owed(inside_0_current, inside_0_mint, liquidity)
+    owed_1 = reference_tokens_owed(inside_1_current, inside_1_mint, liquidity)
+    diff_0 = (inside_0_current - inside_0_mint) % MODULUS
+    expected_int = (owed_0 // Q128, owed_1 // Q128)
+
+    # 整数除法的三种实现是通用的 a * b / denominator，不截断
+    product = diff_0 * liquidity
+    quotient, remainder = mul_div_with_remainder(diff_0, liquidity, Q128)
+    if quotient != product // Q128 or quotient * Q128 + remainder != product or not 0 <= remainder < Q128:
+        failures.append("mul_div_with_remainder")
+    integer, precise = mul_div_with_precision(diff_0, liquidity, Q128)
+    if integer != product // Q128 or precise.numerator * Q128 != product * precise.denominator:
+        failures.append("mul_div_with_precision")
+
+    # 基于快照的计算路径（服务和批量分析使用）
+    mint_snapshot = PoolSnapshot(1, mint[0], mint[1], mint[2], {tick_lower: (mint[3], mint[4]), tick_upper: (mint[5], mint[6])})
+    current_snapshot = PoolSnapshot(2, current[0], current[1], current[2], {tick_lower: (current[3], current[4]), tick_upper: (current[5], current[6])})
+    fees = compute_position_fees(mint_snapshot, current_snapshot, tick_lower, tick_upper, liquidity)
+    if (
+        fees is None
+        or (fees[0], fees[2]) != expected_int
+        or fees[1].numerator * Q128 != owed_0 * fees[1].denominator
+        or fees[3].numerator * Q128 != owed_1 * fees[3].denominator
+    ):
+        failures.append("compute_position_fees")
+
+    if slow:
+        with contextlib.redirect_stdout(_NullWriter()):
+            if mul_div(diff_0, liquidity, Q128) != product // Q128:
+                failures.append("mul_div")
+            owed = update_position(liquidity, inside_0_current, inside_1_current, inside_0_mint, inside_1_mint)
+            precise_owed = update_position_precise(liquidity, inside_0_current, inside_1_current, inside_0_mint, inside_1_mint)
+        if owed != expected_int:
+            failures.append("update_position")
+        if (
+            (precise_owed[0], precise_owed[2]) != owed
+            or precise_owed[1].quotient != precise_owed[0]
+            or precise_owed[3].quotient != precise_owed[2]
+            or precise_owed[1].numerator * Q128 != owed_0 * precise_owed[1].denominator
+            or precise_owed[3].numerator * Q128 != owed_1 * precise_owed[3].denominator
+        ):
+            failures.append("update_position_precise")
+    return failures
+
+
+def check_batch(rng: random.Random) -> list[str]:
+    """
+    批量路径：同一个池子的一批头寸共享mint/当前快照，比较 analyze_pool 的手续费与参考实现
+
+    返回:
+    - list[str]: 不一致的检查项名称
+    """
+    # 从少量tick中取边界，让多个头寸共享同一个tick，并让tick_current落在不同头寸的不同分支
+    tick_pool = sorted(rng.sample(range(MIN_TICK + 1, MAX_TICK), 16))
+    positions = []
+    for _ in range(BATCH_POSITIONS):
+        tick_lower, tick_upper = sorted(rng.sample(tick_pool, 2))
+        positions.append(Position("0xfuzz", tick_lower, tick_upper, _liquidity(rng)))
+
+    snapshots = {}
+    for block in (1, 2):
+        tick_current = rng.choice(tick_pool) + rng.choice((-1, 0, 1))
+        ticks = {tick: (_fee_growth(rng, _below(rng, 8)), _fee_growth(rng, _below(rng, 8))) for tick in tick_pool}
+        snapshots[block] = PoolSnapshot(block, tick_current, _fee_growth(rng, _below(rng, 8)), _fee_growth(rng, _below(rng, 8)), ticks)
+
+    failures = []
+    for position, analytics in zip(positions, analyze_pool(positions, snapshots)):
+        inside = []
+        for snapshot in (snapshots[1], snapshots[2]):
+            lower, upper = snapshot.ticks[position.tick_lower], snapshot.ticks[position.tick_upper]
+            inside.append([
+                reference_fee_growth_inside(position.tick_lower, position.tick_upper, snapshot.tick_current, global_, lower[k], upper[k])
+                for k, global_ in enumerate((snapshot.fee_growth_global_0_x128, snapshot.fee_growth_global_1_x128))
+            ])
+        expected = tuple(reference_tokens_owed(inside[1][k], inside[0][k], position.liquidity) // Q128 for k in (0, 1))
+        if (analytics.fees_0, analytics.fees_1) != expected:
+            failures.append("analyze_pool")
+            break
+    return failures
+
+
+def run_chunk(seed: int, chunk: int, cases: int = CHUNK_SIZE) -> dict:
+    """
+    运行一个分块，同样的 (seed, chunk) 总是生成同样的用例
+
+    返回:
+    - dict: {"cases", "failures": [(分块, 序号, 检查项, 用例)], "branches": Counter, "wraps", "truncations"}
+    """
+    rng = random.Random(f"{seed}:{chunk}")
+    failures = []
+    branches = Counter()
+    wraps = truncations = 0
+    for index in range(cases):
+        case = generate_case(rng)
+        tick_lower, tick_upper, _, mint_branch, mint, current_branch, current = case
+        branches[BRANCHES[mint_branch]] += 1
+        branches[BRANCHES[current_branch]] += 1
+        if _wraps(tick_lower, tick_upper, mint) or _wraps(tick_lower, tick_upper, current):
+            wraps += 1
+        if _truncates(case):
+            truncations += 1
+        names = check_case(case, slow=index % SLOW_EVERY == 0)
+        if index % BATCH_EVERY == 0:
+            names += check_batch(rng)
+        for name in names:
+            if len(failures) < MAX_FAILURES:
+                failures.append((chunk, index, name, case))
+    return {"cases": cases, "failures": failures, "branches": branches, "wraps": wraps, "truncations": truncations}
+
+
+def _run_chunk_args(args: tuple) -> dict:
+    return run_chunk(*args)
+
+
+def run(seed: int = 0, cases: int = 1_000_000, seconds: float = None, workers: int = 1, chunks: list[int] = None) -> dict:
+    """
+    运行差分测试
+
+    参数:
+    - seed: 随机种子
+    - cases: 用例总数（按分块向上取整）
+    - seconds: 设置后改为按时间运行，忽略 cases
+    - workers: 进程数
+    - chunks: 只运行指定的分块（用于重放失败用例）
+
+    返回:
+    - dict: 汇总结果，字段同 run_chunk，另有 "elapsed"
+    """
+    if chunks is None:
+        chunks = range(10 ** 12) if seconds is not None else range(-(-cases // CHUNK_SIZE))
+    deadline = time.perf_counter() + seconds if seconds is not None else None
+    total = {"cases": 0, "failures": [], "branches": Counter(), "wraps": 0, "truncations": 0}
+    start = time.perf_counter()
+
+    def merge(result):
+        total["cases"] += result["cases"]
+        total["failures"] += result["failures"]
+        total["branches"].update(result["branches"])
+        total["wraps"] += result["wraps"]
+        total["truncations"] += result["truncations"]
+
+    jobs = ((seed, chunk) for chunk in chunks)
+    if workers > 1:
+        from multiprocessing import Pool
+
+        with Pool(workers) as pool:
+            for result in pool.imap(_run_chunk_args, jobs):
+                merge(result)
+                if deadline is not None and time.perf_counter() >= deadline:
+                    pool.terminate()
+                    break
+    else:
+        for job in jobs:
+            merge(run_chunk(*job))
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+    total["elapsed"] = time.perf_counter() - start
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="手续费计算的确定性差分测试")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cases", type=int, default=1_000_000)
+    parser.add_argument("--seconds", type=float, default=None, help="按时间运行")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk", type=int, action="append", help="只运行指定分块（可重复）")
+    args = parser.parse_args()
+
+    result = run(args.seed, args.cases, args.seconds, args.workers, args.chunk)
+    rate = result["cases"] / result["elapsed"] * 60 if result["elapsed"] else 0.0
+    print(f"用例: {result['cases']}, 耗时: {result['elapsed']:.1f}s, 约 {rate:,.0f} 个/分钟")
+    print(f"分支覆盖: {dict(result['branches'])}, 发生回绕的用例: {result['wraps']}, 手续费被uint128截断的用例: {result['truncations']}")
+
+    missing = [branch for branch in BRANCHES if not result["branches"][branch]]
+    if missing and result["cases"] >= CHUNK_SIZE:
+        print(f"未覆盖的分支: {missing}")
+        sys.exit(1)
+    if result["failures"]:
+        for chunk, index, name, case in result["failures"][:MAX_FAILURES]:
+            print(f"不一致: {name} (seed={args.seed}, chunk={chunk}, index={index}) {case}")
+        sys.exit(1)
+    print("全部一致")
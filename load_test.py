@@ -0,0 +1,120 @@
+import argparse
+import http.client
+import json
+import os
+import threading
+import time
+
+from stub_servers import StubSubgraphHandler, start_stub_server
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_load_test(
+    concurrency: int = 16,
+    requests_per_worker: int = 200,
+    distinct_positions: int = 50,
+    stub_latency: float = 0.02
+) -> dict:
+    """
+    启动假子图和报价服务，并发发送报价请求，统计吞吐量和延迟
+
+    参数:
+    - concurrency: 并发客户端数量
+    - requests_per_worker: 每个客户端发送的请求数
+    - distinct_positions: 不同头寸的数量（越少，请求合并与缓存命中越多）
+    - stub_latency: 假子图每个请求的延迟（秒）
+
+    返回:
+    - dict: 压测结果
+    """
+    stub_server, stub_handler = start_stub_server(StubSubgraphHandler, latency=stub_latency)
+    # 必须在导入报价服务之前设置，数据源地址在导入时读取
+    os.environ["GRAPH_API_URL"] = f"http://127.0.0.1:{stub_server.server_address[1]}/"
+    from fee_service import make_server
+    from metrics import METRICS
+
+    METRICS.enable()
+    METRICS.reset()
+    server = make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    pool_id = "0x4e68ccd3e89f51c3074ca5072bbac773960dfa36"
+    positions = [
+        {
+            "pool_id": pool_id,
+            "mint_block_number": 18408173 + i % 7,
+            "current_block_number": 23438173,
+            "tick_lower": -200580 + 60 * i,
+            "tick_upper": -191220 + 60 * i,
+            "liquidity": 500000 + i,
+            "token0_decimals": 18,
+            "token1_decimals": 6,
+        }
+        for i in range(distinct_positions)
+    ]
+
+    latencies: list[float] = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(worker_id: int):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        local = []
+        for i in range(requests_per_worker):
+            body = json.dumps(positions[(worker_id * 31 + i) % len(positions)])
+            start = time.perf_counter()
+            conn.request("POST", "/quote", body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            local.append(time.perf_counter() - start)
+            if resp.status != 200:
+                with lock:
+                    errors[0] += 1
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    server.shutdown()
+    stub_server.shutdown()
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "subgraph_requests": stub_handler.request_count,
+        "counters": METRICS.to_dict()["counters"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="报价服务压测（使用本地假子图）")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="每个客户端的请求数")
+    parser.add_argument("--positions", type=int, default=50, help="不同头寸的数量")
+    parser.add_argument("--stub-latency", type=float, default=0.02, help="假子图延迟（秒）")
+    args = parser.parse_args()
+
+    result = run_load_test(args.concurrency, args.requests, args.positions, args.stub_latency)
+    print("=== 压测结果 ===")
+    for name, value in result.items():
+        print(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}")
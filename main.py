@@ -1,6 +1,7 @@
 from fee_growth_calculator import get_fee_growth_inside
 from position_updater import update_position, update_position_precise
 from GetFeeGrowth import fetch_pool_data
+from subgraph_decoder import SubgraphError
 
 
 def convert_to_token_amount(raw_amount: float, decimals: int) -> float:
@@ -62,20 +63,25 @@ def main():
     print(f"当前区块号: {block_number}")
     print(f"查询Tick范围: [{tick_lower}, {tick_upper}]")
     
-    # 第一步：从链上获取mint区块的lower tick数据
-    print(f"\n第一步：获取mint区块({mint_number})的下边界tick数据")
-    lower_fee_growth_outside_0_x128_mint, lower_fee_growth_outside_1_x128_mint, fee_growth_global_0_x128_mint, fee_growth_global_1_x128_mint, tick_current_mint = fetch_pool_data(pool_id, mint_number, tick_lower)
-    
-    # 第二步：获取mint区块的上边界tick数据
-    print(f"\n第二步：获取mint区块({mint_number})的上边界tick数据")
-    upper_fee_growth_outside_0_x128_mint, upper_fee_growth_outside_1_x128_mint, _, _, _ = fetch_pool_data(pool_id, mint_number, tick_upper)
-    
-    # 第三步：获取当前区块的数据
-    print(f"\n第三步：获取当前区块({block_number})的下边界tick数据")
-    lower_fee_growth_outside_0_x128, lower_fee_growth_outside_1_x128, fee_growth_global_0_x128, fee_growth_global_1_x128, tick_current = fetch_pool_data(pool_id, block_number, tick_lower)
-    
-    print(f"\n第四步：获取当前区块({block_number})的上边界tick数据")
-    upper_fee_growth_outside_0_x128, upper_fee_growth_outside_1_x128, _, _, _ = fetch_pool_data(pool_id, block_number, tick_upper)
+    try:
+        # 第一步：从链上获取mint区块的lower tick数据
+        print(f"\n第一步：获取mint区块({mint_number})的下边界tick数据")
+        lower_fee_growth_outside_0_x128_mint, lower_fee_growth_outside_1_x128_mint, fee_growth_global_0_x128_mint, fee_growth_global_1_x128_mint, tick_current_mint = fetch_pool_data(pool_id, mint_number, tick_lower)
+
+        # 第二步：获取mint区块的上边界tick数据
+        print(f"\n第二步：获取mint区块({mint_number})的上边界tick数据")
+        upper_fee_growth_outside_0_x128_mint, upper_fee_growth_outside_1_x128_mint, _, _, _ = fetch_pool_data(pool_id, mint_number, tick_upper)
+
+        # 第三步：获取当前区块的数据
+        print(f"\n第三步：获取当前区块({block_number})的下边界tick数据")
+        lower_fee_growth_outside_0_x128, lower_fee_growth_outside_1_x128, fee_growth_global_0_x128, fee_growth_global_1_x128, tick_current = fetch_pool_data(pool_id, block_number, tick_lower)
+
+        print(f"\n第四步：获取当前区块({block_number})的上边界tick数据")
+        upper_fee_growth_outside_0_x128, upper_fee_growth_outside_1_x128, _, _, _ = fetch_pool_data(pool_id, block_number, tick_upper)
+    except SubgraphError as exc:
+        print(f"\n子图请求失败：{exc}")
+        lower_fee_growth_outside_0_x128_mint = upper_fee_growth_outside_0_x128_mint = None
+        lower_fee_growth_outside_0_x128 = upper_fee_growth_outside_0_x128 = None
     
     # 检查数据获取是否成功
     if (lower_fee_growth_outside_0_x128_mint is None or upper_fee_growth_outside_0_x128_mint is None or 
@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# 直方图桶边界（秒），与Prometheus客户端默认桶一致
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _NullTimer:
+    """
+    关闭埋点时使用的空计时器，所有调用方共享同一个实例，不产生任何分配
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    """
+    单次阶段计时，退出时把耗时写入对应阶段的直方图
+    """
+    __slots__ = ("_metrics", "_name", "_start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self._metrics = metrics
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.observe(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class Histogram:
+    """
+    固定桶的耗时直方图（桶语义为 le，即 <= 边界值）
+    """
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # 最后一个位置对应 +Inf 桶
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """
+        返回:
+        - list[tuple[str, int]]: [(桶边界, 累计次数), ...]，最后一项为 "+Inf"
+        """
+        result = []
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            result.append((repr(float(bound)), running))
+        result.append(("+Inf", self.count))
+        return result
+
+
+class Metrics:
+    """
+    手续费计算流程的分阶段计时与计数器
+
+    关闭时 stage() 直接返回共享的空计时器、incr() 立即返回，热路径上只多一次属性判断。
+    常用计数器：fetch_count（请求次数）、fetch_bytes（响应字节数）、cache_hits（缓存命中）、
+    fetch_errors（请求失败）。
+    """
+
+    def __init__(self, enabled: bool = False, buckets: tuple = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: dict[str, int] = {}
+        self._stages: dict[str, Histogram] = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._stages.clear()
+
+    def stage(self, name: str):
+        """
+        阶段计时上下文管理器，用法: with METRICS.stage("fetch"): ...
+
+        参数:
+        - name: 阶段名称
+
+        返回:
+        - 上下文管理器
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, name)
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        手动记录一次阶段耗时
+
+        参数:
+        - name: 阶段名称
+        - seconds: 耗时（秒）
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._stages.get(name)
+            if histogram is None:
+                histogram = self._stages[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """
+        计数器累加
+
+        参数:
+        - name: 计数器名称
+        - value: 增量，默认为1
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def to_dict(self) -> dict:
+        """
+        导出为字典
+
+        返回:
+        - dict: {"counters": {名称: 值}, "stages": {阶段: {"count", "sum", "buckets"}}}
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "stages": {
+                    name: {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": dict(histogram.cumulative()),
+                    }
+                    for name, histogram in self._stages.items()
+                },
+            }
+
+    def to_prometheus(self, prefix: str = "lp_fee") -> str:
+        """
+        导出为Prometheus文本格式
+
+        参数:
+        - prefix: 指标名前缀
+
+        返回:
+        - str: Prometheus exposition 文本
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                metric = f"{prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {self._counters[name]}")
+
+            if self._stages:
+                metric = f"{prefix}_stage_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                for name in sorted(self._stages):
+                    histogram = self._stages[name]
+                    for bound, count in histogram.cumulative():
+                        lines.append(f'{metric}_bucket{{stage="{name}",le="{bound}"}} {count}')
+                    lines.append(f'{metric}_sum{{stage="{name}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{stage="{name}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+# 全局埋点实例，设置环境变量 LP_FEE_METRICS=1 开启
+METRICS = Metrics(enabled=os.getenv("LP_FEE_METRICS", "").lower() in ("1", "true", "yes"))
+
+
+# 示例用法
+if __name__ == "__main__":
+    METRICS.enable()
+    for _ in range(3):
+        with METRICS.stage("fetch"):
+            time.sleep(0.002)
+        METRICS.incr("fetch_count")
+        METRICS.incr("fetch_bytes", 512)
+
+    print(METRICS.to_dict())
+    print(METRICS.to_prometheus())
@@ -1,10 +1,17 @@
+from fee_growth_calculator import MAX_UINT256
+from metrics import METRICS
+from precision import ExactAmount
+
+MAX_UINT128 = 2 ** 128 - 1
+
+
 def update_position_precise(
     liquidity: int,
     fee_growth_inside_0_x128: int,
     fee_growth_inside_1_x128: int,
     fee_growth_inside_0_last_x128: int,
     fee_growth_inside_1_last_x128: int
-) -> tuple[int, float, int, float]:
+) -> tuple[int, ExactAmount, int, ExactAmount]:
     """
     更新流动性头寸（精确版本，包含小数结果）
     
@@ -16,7 +23,7 @@ def update_position_precise(
     - fee_growth_inside_1_last_x128: 上次记录的token1手续费增长
     
     返回:
-    - tuple[int, float, int, float]: (token0整数手续费, token0精确手续费, token1整数手续费, token1精确手续费)
+    - tuple[int, ExactAmount, int, ExactAmount]: (token0整数手续费, token0精确手续费, token1整数手续费, token1精确手续费)
     """
     
     # 检查流动性值
@@ -27,25 +34,25 @@ def update_position_precise(
     # Q128 = 2^128
     Q128 = 2 ** 128
     
-    # 计算token0手续费
-    fee_growth_diff_0 = fee_growth_inside_0_x128 - fee_growth_inside_0_last_x128
+    # 计算token0手续费（与合约一致，增长差值按 2^256 取模）
+    fee_growth_diff_0 = (fee_growth_inside_0_x128 - fee_growth_inside_0_last_x128) & MAX_UINT256
     print(f"Token0手续费增长差值: {fee_growth_diff_0}")
     
-    tokens_owed_0_int, tokens_owed_0_precise = mul_div_with_precision(
+    tokens_owed_0_int, tokens_owed_0_precise = truncate_tokens_owed(*mul_div_with_precision(
         fee_growth_diff_0,
         liquidity,
         Q128
-    )
+    ))
     
     # 计算token1手续费
-    fee_growth_diff_1 = fee_growth_inside_1_x128 - fee_growth_inside_1_last_x128
+    fee_growth_diff_1 = (fee_growth_inside_1_x128 - fee_growth_inside_1_last_x128) & MAX_UINT256
     print(f"Token1手续费增长差值: {fee_growth_diff_1}")
     
-    tokens_owed_1_int, tokens_owed_1_precise = mul_div_with_precision(
+    tokens_owed_1_int, tokens_owed_1_precise = truncate_tokens_owed(*mul_div_with_precision(
         fee_growth_diff_1,
         liquidity,
         Q128
-    )
+    ))
     
     print(f"流动性: {liquidity}")
     print(f"Q128: {Q128}")
@@ -84,25 +91,26 @@ def update_position(
     # Q128 = 2^128
     Q128 = 2 ** 128
     
-    # 计算token0手续费
-    fee_growth_diff_0 = fee_growth_inside_0_x128 - fee_growth_inside_0_last_x128
+    # 计算token0手续费（与合约一致，增长差值按 2^256 取模）
+    fee_growth_diff_0 = (fee_growth_inside_0_x128 - fee_growth_inside_0_last_x128) & MAX_UINT256
     print(f"Token0手续费增长差值: {fee_growth_diff_0}")
     
+    # 与合约一致，结果转换为uint128时截断高位
     tokens_owed_0_new = mul_div(
         fee_growth_diff_0,
         liquidity,
         Q128
-    )
+    ) & MAX_UINT128
     
     # 计算token1手续费
-    fee_growth_diff_1 = fee_growth_inside_1_x128 - fee_growth_inside_1_last_x128
+    fee_growth_diff_1 = (fee_growth_inside_1_x128 - fee_growth_inside_1_last_x128) & MAX_UINT256
     print(f"Token1手续费增长差值: {fee_growth_diff_1}")
     
     tokens_owed_1_new = mul_div(
         fee_growth_diff_1,
         liquidity,
         Q128
-    )
+    ) & MAX_UINT128
     
     print(f"流动性: {liquidity}")
     print(f"Q128: {Q128}")
@@ -111,6 +119,24 @@ def update_position(
     return tokens_owed_0_new, tokens_owed_1_new
 
 
+def truncate_tokens_owed(tokens_owed_int: int, tokens_owed_precise: ExactAmount) -> tuple[int, ExactAmount]:
+    """
+    与合约 Position.update 中的 uint128(FullMath.mulDiv(...)) 一致，新产生的手续费超过uint128时截断高位；
+    精确结果减去同样被截掉的部分，小数部分不变
+
+    参数:
+    - tokens_owed_int: 整数手续费
+    - tokens_owed_precise: 精确手续费
+
+    返回:
+    - tuple[int, ExactAmount]: (截断后的整数手续费, 截断后的精确手续费)
+    """
+    truncated = tokens_owed_int & MAX_UINT128
+    if truncated == tokens_owed_int:
+        return tokens_owed_int, tokens_owed_precise
+    return truncated, tokens_owed_precise - (tokens_owed_int - truncated)
+
+
 def add_delta(x: int, y: int) -> int:
     """
     安全地将流动性变化量添加到当前流动性
@@ -131,9 +157,9 @@ def add_delta(x: int, y: int) -> int:
         return x + y
 
 
-def mul_div_with_precision(a: int, b: int, denominator: int) -> tuple[int, float]:
+def mul_div_with_remainder(a: int, b: int, denominator: int) -> tuple[int, int]:
     """
-    计算 (a * b) / denominator，返回整数结果和精确的浮点数结果
+    计算 (a * b) / denominator，返回商和余数（纯整数快速路径）
     
     参数:
     - a: 被乘数
@@ -141,14 +167,36 @@ def mul_div_with_precision(a: int, b: int, denominator: int) -> tuple[int, float
     - denominator: 除数
     
     返回:
-    - tuple[int, float]: (整数结果, 精确的浮点数结果)
+    - tuple[int, int]: (整数结果, 余数)，满足 a * b = 整数结果 * denominator + 余数
     """
     if denominator == 0:
         raise ValueError("除数不能为零")
     
-    numerator = a * b
-    integer_result = numerator // denominator
-    precise_result = numerator / denominator
+    return divmod(a * b, denominator)
+
+
+def mul_div_with_precision(a: int, b: int, denominator: int) -> tuple[int, ExactAmount]:
+    """
+    计算 (a * b) / denominator，返回整数结果和精确结果
+    
+    精确结果是以整数保存的有理数，不会像 float 那样只保留53位；
+    需要显示时再通过格式化或 to_decimal() 转换为Decimal
+    
+    参数:
+    - a: 被乘数
+    - b: 乘数  
+    - denominator: 除数
+    
+    返回:
+    - tuple[int, ExactAmount]: (整数结果, 精确结果)
+    """
+    if denominator == 0:
+        raise ValueError("除数不能为零")
+    
+    with METRICS.stage("mul_div"):
+        numerator = a * b
+        integer_result = numerator // denominator
+        precise_result = ExactAmount(numerator, denominator)
     
     return integer_result, precise_result
 
@@ -0,0 +1,378 @@
+import math
+import numbers
+import operator
+import re
+from decimal import Decimal, localcontext
+from fractions import Fraction
+from math import gcd
+
+# 未指定精度时转换为Decimal保留的小数位数
+DEFAULT_DIGITS = 40
+# float可以无损往返的十进制有效数字位数
+_FLOAT_DIGITS = 15
+
+# 格式串拆成 [填充/对齐/符号/宽度/分组][.精度][类型]
+_SPEC_RE = re.compile(r"(?P<head>.*?)(?:\.(?P<precision>\d+))?(?P<type>[eEfFgG%]?)", re.S)
+_EXPONENT_RE = re.compile(r"([eE][+-])(\d)(?!\d)")
+
+
+def _coerce(value):
+    # 返回精确的 ExactAmount；float按其二进制值精确转换（同 Fraction(float)），无法转换时返回None
+    if isinstance(value, ExactAmount):
+        return value
+    if isinstance(value, int):
+        return ExactAmount(value)
+    if isinstance(value, numbers.Rational):
+        return ExactAmount(value.numerator, value.denominator)
+    if isinstance(value, float) and math.isfinite(value):
+        return ExactAmount(*value.as_integer_ratio())
+    return None
+
+
+def _add(a, b):
+    # 同一分母（通常都是Q128）时只做一次整数加法
+    if a.denominator == b.denominator:
+        return ExactAmount(a.numerator + b.numerator, a.denominator)
+    return ExactAmount(a.numerator * b.denominator + b.numerator * a.denominator, a.denominator * b.denominator)
+
+
+def _sub(a, b):
+    if a.denominator == b.denominator:
+        return ExactAmount(a.numerator - b.numerator, a.denominator)
+    return ExactAmount(a.numerator * b.denominator - b.numerator * a.denominator, a.denominator * b.denominator)
+
+
+def _mul(a, b):
+    return ExactAmount(a.numerator * b.numerator, a.denominator * b.denominator)
+
+
+def _truediv(a, b):
+    if b.numerator == 0:
+        raise ZeroDivisionError("除数不能为零")
+    # 支持 raw_amount / (10 ** decimals) 这种换算写法，只放大分母
+    if b.denominator == 1:
+        return ExactAmount(a.numerator, a.denominator * b.numerator)
+    return ExactAmount(a.numerator * b.denominator, a.denominator * b.numerator)
+
+
+def _floordiv(a, b):
+    if b.numerator == 0:
+        raise ZeroDivisionError("除数不能为零")
+    return (a.numerator * b.denominator) // (a.denominator * b.numerator)
+
+
+def _mod(a, b):
+    return a - b * _floordiv(a, b)
+
+
+def _operators(exact_op, float_op):
+    """
+    生成正向和反向运算符：与 int / Fraction / 有限float 运算时结果精确，与 inf/nan 运算时退回float
+    """
+    def forward(a, b):
+        if isinstance(b, float) and not math.isfinite(b):
+            return float_op(float(a), b)
+        b = _coerce(b)
+        if b is None:
+            return NotImplemented
+        return exact_op(a, b)
+
+    def reverse(b, a):
+        if isinstance(a, float) and not math.isfinite(a):
+            return float_op(a, float(b))
+        a = _coerce(a)
+        if a is None:
+            return NotImplemented
+        return exact_op(a, b)
+
+    return forward, reverse
+
+
+def _comparison(op):
+    def compare(a, b):
+        if isinstance(b, float) and not math.isfinite(b):
+            # 有限值与 inf/nan 比较的结果与0相同
+            return op(0.0, b)
+        b = _coerce(b)
+        if b is None:
+            return NotImplemented
+        # 分母始终为正，交叉相乘不改变大小关系
+        return op(a.numerator * b.denominator, b.numerator * a.denominator)
+
+    return compare
+
+
+class ExactAmount:
+    """
+    精确的有理数数量 numerator / denominator
+
+    内部只保存两个整数，加减和缩放都是整数运算（不像 Fraction 那样每次求最大公约数）；只有在显示
+    （format / to_decimal）时才构造Decimal，因此可以在大量头寸上累加亚wei级的余数而不损失精度，也不付出Decimal的开销。
+
+    实现了 numbers.Rational 的接口，可以替代原来的float使用：与 int、Fraction 和有限float
+    （按二进制值精确转换）运算和比较的结果都是精确的，格式化时按格式串的精度精确舍入。
+    """
+    __slots__ = ("numerator", "denominator")
+
+    def __init__(self, numerator: int, denominator: int = 1):
+        if denominator == 0:
+            raise ValueError("除数不能为零")
+        if denominator < 0:
+            numerator, denominator = -numerator, -denominator
+        self.numerator = numerator
+        self.denominator = denominator
+
+    @property
+    def quotient(self) -> int:
+        """整数部分（向下取整，与 mul_div 一致）"""
+        return self.numerator // self.denominator
+
+    @property
+    def remainder(self) -> int:
+        """余数，满足 numerator = quotient * denominator + remainder"""
+        return self.numerator % self.denominator
+
+    @property
+    def real(self):
+        return self
+
+    @property
+    def imag(self) -> int:
+        return 0
+
+    def conjugate(self):
+        return self
+
+    def to_fraction(self) -> Fraction:
+        return Fraction(self.numerator, self.denominator)
+
+    def to_decimal(self, digits: int = DEFAULT_DIGITS) -> Decimal:
+        """
+        转换为保留 digits 位小数的Decimal（银行家舍入），不受decimal上下文精度限制
+
+        参数:
+        - digits: 小数位数，负数表示舍入到十位、百位等
+
+        返回:
+        - Decimal: 舍入后的结果
+        """
+        negative = self.numerator < 0
+        if digits >= 0:
+            unit = self.denominator
+            scaled, rest = divmod(abs(self.numerator) * 10 ** digits, unit)
+        else:
+            unit = self.denominator * 10 ** -digits
+            scaled, rest = divmod(abs(self.numerator), unit)
+        if 2 * rest > unit or (2 * rest == unit and scaled & 1):
+            scaled += 1
+        # 与float一致，舍入为0的负数保留负号（-0.00）
+        return Decimal(f"{'-' if negative else ''}{scaled}E{-digits}")
+
+    def _exponent(self) -> int:
+        # 十进制指数 floor(log10(|x|))，x 不为0；位数之差与真实指数最多差1
+        numerator, denominator = abs(self.numerator), self.denominator
+        exponent = len(str(numerator)) - len(str(denominator))
+        if exponent >= 0:
+            below = numerator < denominator * 10 ** exponent
+        else:
+            below = numerator * 10 ** -exponent < denominator
+        return exponent - 1 if below else exponent
+
+    def _significant(self, digits: int) -> Decimal:
+        # 精确舍入到 digits 位有效数字
+        if self.numerator == 0:
+            return Decimal(0)
+        return self.to_decimal(digits - 1 - self._exponent())
+
+    __add__, __radd__ = _operators(_add, operator.add)
+    __sub__, __rsub__ = _operators(_sub, operator.sub)
+    __mul__, __rmul__ = _operators(_mul, operator.mul)
+    __truediv__, __rtruediv__ = _operators(_truediv, operator.truediv)
+    __floordiv__, __rfloordiv__ = _operators(_floordiv, operator.floordiv)
+    __mod__, __rmod__ = _operators(_mod, operator.mod)
+
+    def __divmod__(self, other):
+        return self // other, self % other
+
+    def __rdivmod__(self, other):
+        return other // self, other % self
+
+    def __pow__(self, exponent):
+        if not isinstance(exponent, int):
+            return float(self) ** exponent
+        if exponent >= 0:
+            return ExactAmount(self.numerator ** exponent, self.denominator ** exponent)
+        if self.numerator == 0:
+            raise ZeroDivisionError("除数不能为零")
+        return ExactAmount(self.denominator ** -exponent, self.numerator ** -exponent)
+
+    def __rpow__(self, base):
+        if self.denominator == 1:
+            return base ** self.numerator
+        return base ** float(self)
+
+    def __neg__(self):
+        return ExactAmount(-self.numerator, self.denominator)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return ExactAmount(abs(self.numerator), self.denominator)
+
+    def __bool__(self) -> bool:
+        return self.numerator != 0
+
+    def __trunc__(self) -> int:
+        # 向零取整，与 int(float) 一致
+        if self.numerator < 0:
+            return -(-self.numerator // self.denominator)
+        return self.numerator // self.denominator
+
+    __int__ = __trunc__
+
+    def __floor__(self) -> int:
+        return self.numerator // self.denominator
+
+    def __ceil__(self) -> int:
+        return -(-self.numerator // self.denominator)
+
+    def __round__(self, ndigits: int = None):
+        """
+        银行家舍入（与 round(float) / round(Fraction) 一致）：不传 ndigits 时返回int，否则返回 ExactAmount
+        """
+        if ndigits is None:
+            floor, rest = divmod(self.numerator, self.denominator)
+            if 2 * rest < self.denominator or (2 * rest == self.denominator and floor % 2 == 0):
+                return floor
+            return floor + 1
+        shift = 10 ** abs(ndigits)
+        if ndigits > 0:
+            return ExactAmount(round(self * shift), shift)
+        return ExactAmount(round(self / shift) * shift)
+
+    def __float__(self) -> float:
+        # Python的 int / int 是正确舍入的，不会先把大整数截断成float
+        return self.numerator / self.denominator
+
+    __eq__ = _comparison(operator.eq)
+    __lt__ = _comparison(operator.lt)
+    __le__ = _comparison(operator.le)
+    __gt__ = _comparison(operator.gt)
+    __ge__ = _comparison(operator.ge)
+
+    def __hash__(self):
+        # 与相等的 int / float / Fraction 的哈希值相同
+        return hash(self.to_fraction())
+
+    def __format__(self, spec: str) -> str:
+        # 先按格式串的精度精确舍入，再交给float或Decimal格式化，避免二次舍入
+        match = _SPEC_RE.fullmatch(spec)
+        head, precision, kind = match.group("head"), match.group("precision"), match.group("type")
+        if not kind and precision is None:
+            return format(Decimal(str(self)), head)
+        if kind in ("f", "F"):
+            return format(self.to_decimal(DEFAULT_DIGITS if precision is None else int(precision)), spec)
+        if kind == "%":
+            digits = 6 if precision is None else int(precision)
+            return format(self.to_decimal(digits + 2), f"{head}.{digits}%")
+
+        digits = 6 if precision is None else int(precision)
+        if kind in ("e", "E"):
+            significant = digits + 1
+        else:
+            # g/G 和只指定精度的情况，精度表示有效数字位数
+            digits = significant = max(digits, 1)
+        value = self._significant(significant)
+        spec = f"{head}.{digits}{kind}"
+        if significant <= _FLOAT_DIGITS or self.numerator == 0:
+            # 已经精确舍入到不超过15位有效数字，float往返不会改变这些数字，输出形式与float完全一致
+            as_float = float(value)
+            if math.isfinite(as_float) and (as_float != 0 or self.numerator == 0):
+                return format(as_float, spec)
+        if kind in ("g", "G", "") and "#" not in head:
+            # 与float一致，g格式去掉末尾的0
+            with localcontext() as context:
+                context.prec = max(significant, 28)
+                value = value.normalize()
+        # Decimal的指数只有一位时补成两位，与float一致
+        return _EXPONENT_RE.sub(r"\g<1>0\2", format(value, spec))
+
+    def __str__(self) -> str:
+        # 分母只含因子2和5时小数是有限的（Q128及10的幂换算都属于这种情况），输出全部位数即为精确值；
+        # 否则保留 DEFAULT_DIGITS 位。去掉末尾的0，不使用科学计数法
+        denominator = self.denominator // gcd(self.numerator, self.denominator)
+        twos = fives = 0
+        while denominator % 2 == 0:
+            denominator //= 2
+            twos += 1
+        while denominator % 5 == 0:
+            denominator //= 5
+            fives += 1
+        digits = max(twos, fives) if denominator == 1 else DEFAULT_DIGITS
+        text = format(self.to_decimal(digits), "f")
+        if "." in text:
+            text = text.rstrip("0").rstrip(".")
+        return "0" if text == "-0" else text
+
+    def __repr__(self) -> str:
+        return f"ExactAmount({self.numerator}, {self.denominator})"
+
+
+numbers.Rational.register(ExactAmount)
+
+
+def _self_check() -> None:
+    """
+    检查 ExactAmount 作为原来float返回值的替代品时的行为（仓库没有pytest，运行本模块即执行）
+    """
+    half = ExactAmount(3, 2)
+    zero = ExactAmount(0, 2 ** 128)
+    assert not zero and half and bool(ExactAmount(-1, 3))
+    assert half == 1.5 and 1.5 == half and half != 1.25 and hash(half) == hash(1.5) == hash(Fraction(3, 2))
+    assert half > 0.5 and 0.5 < half and half >= 1.5 and half <= Fraction(3, 2) and not half < 1
+    assert half != float("nan") and half < float("inf") and not half > float("inf")
+    assert half * 1.5 == Fraction(9, 4) and 1.5 * half == Fraction(9, 4) and isinstance(half * 1.5, ExactAmount)
+    assert half / 2.0 == 0.75 and 3 / half == 2 and half + 0.5 == 2 and 0.5 + half == 2 and 2.5 - half == 1
+    assert half * Fraction(2, 3) == 1 and Fraction(1, 2) + half == 2 and half ** 2 == 2.25 and half ** -1 == Fraction(2, 3)
+    assert half // 1 == 1 and half % 1 == 0.5 and divmod(ExactAmount(7, 2), 2) == (1, 1.5)
+    assert abs(ExactAmount(-3, 2)) == half and -half == -1.5 and +half is half
+    assert int(ExactAmount(-7, 2)) == -3 and int(half) == 1 and math.floor(ExactAmount(-7, 2)) == -4 and math.ceil(half) == 2
+    assert round(half) == 2 and round(ExactAmount(5, 2)) == 2 and round(ExactAmount(-5, 2)) == -2
+    assert round(ExactAmount(12345, 1000), 2) == Fraction(617, 50) and round(ExactAmount(1250), -2) == 1200
+    assert isinstance(half, numbers.Rational) and isinstance(half, numbers.Number)
+    assert math.isclose(half, 1.5) and sum([half, 1, 0.5]) == 3
+
+    for value in (0.0, 1.5, -1.5, 2 / 3, 123456.789, 1e-9, 9.9999995, 6.02214076e23, -0.000123456789):
+        amount = _coerce(value)
+        for spec in ("g", ".3g", ".10g", "e", ".3e", "E", ".0e", ".2%", "%", ".4f", ".12", ">14.3e", "+.2e", ",.2f"):
+            # float的%格式先在二进制下乘以100，大数会多出误差，用Decimal(value)的精确结果比较
+            if spec.endswith("%"):
+                expected = format(Decimal(value), spec if "." in spec else spec[:-1] + ".6%")
+            else:
+                expected = format(value, spec)
+            assert format(amount, spec) == expected, (value, spec, format(amount, spec), expected)
+    assert str(zero) == "0" and str(ExactAmount(-3, 4)) == "-0.75" and f"{half}" == "1.5"
+    # 超过float精度时仍然精确舍入
+    big = ExactAmount(2 ** 200 + 1, 2 ** 128)
+    assert format(big, ".25e") == "4.7223664828696452136960000e+21"
+    assert format(ExactAmount(1, 3), ".20g") == "0.33333333333333333333"
+    assert format(ExactAmount(3, 2), ".20g") == "1.5"
+
+
+# 示例用法
+if __name__ == "__main__":
+    Q128 = 2 ** 128
+    amount = ExactAmount((2 ** 200 + 12345) * 500000, Q128)
+    print(f"整数部分: {amount.quotient}, 余数: {amount.remainder}")
+    print(f"float: {float(amount)}")
+    print(f"精确: {amount:.10f}")
+    print(f"科学计数法: {amount:.3e}, 有效数字: {amount:g}")
+    print(f"换算为18位精度代币: {amount / (10 ** 18):.22f}")
+
+    # 大量头寸的亚wei余数累加
+    total = sum(ExactAmount(Q128 // 3, Q128) for _ in range(1000000))
+    print(f"100万个 1/3 wei 累加: {total:.6f}")
+
+    _self_check()
+    print("自检通过")
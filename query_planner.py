@@ -0,0 +1,276 @@
+import requests
+from functools import lru_cache
+from typing import NamedTuple
+
+from GetFeeGrowth import URL, API_KEY, SUBGRAPH_TIMEOUT
+from metrics import METRICS
+from subgraph_decoder import (
+    MalformedResponseError,
+    SubgraphConnectionError,
+    SubgraphError,
+    SubgraphHTTPError,
+    decode_graphql_body,
+    ticks_to_dict,
+)
+
+# 子图端点的限制（按The Graph托管服务的默认值估算）
+MAX_ALIASES_PER_QUERY = 50        # 单个请求中的 pool(block:) 别名数量上限
+MAX_TICKS_PER_SELECTION = 1000    # ticks(first:) 的上限
+MAX_QUERY_ENTITIES = 5000         # 单个请求返回的实体数上限（查询复杂度）
+MAX_RESPONSE_BYTES = 4_000_000    # 单个响应体大小上限
+
+# 响应体大小估算：pool 字段约200字节，每个tick约240字节（两个256位整数）
+EST_POOL_BYTES = 200
+EST_TICK_BYTES = 240
+
+_POOL_SELECTION = """
+  %(alias)s: pool(id: $pool, block: {number: $%(alias)s}) {
+    tick
+    feeGrowthGlobal0X128
+    feeGrowthGlobal1X128
+    ticks(first: $first, where: {id_in: $ticks}) {
+      tickIdx
+      feeGrowthOutside0X128
+      feeGrowthOutside1X128
+    }
+  }"""
+
+
+_META_QUERY = "{ _meta { block { number } } }"
+
+class PoolSnapshot(NamedTuple):
+    """
+    某个区块下池子的状态快照
+    """
+    block_number: int
+    tick_current: int
+    fee_growth_global_0_x128: int
+    fee_growth_global_1_x128: int
+    ticks: dict  # tick -> (fee_growth_outside_0_x128, fee_growth_outside_1_x128)
+
+
+def snapshot_tick_data(snapshot, tick: int) -> tuple:
+    """
+    从快照中取出与 fetch_pool_data 相同格式的返回值
+
+    参数:
+    - snapshot: PoolSnapshot，可以为None
+    - tick: tick值
+
+    返回:
+    - tuple: (fee_growth_outside_0_x128, fee_growth_outside_1_x128, fee_growth_global_0_x128,
+              fee_growth_global_1_x128, current_tick)，缺少数据时全部为None
+    """
+    if snapshot is None or int(tick) not in snapshot.ticks:
+        return None, None, None, None, None
+    fee_growth_outside_0_x128, fee_growth_outside_1_x128 = snapshot.ticks[int(tick)]
+    return (
+        fee_growth_outside_0_x128,
+        fee_growth_outside_1_x128,
+        snapshot.fee_growth_global_0_x128,
+        snapshot.fee_growth_global_1_x128,
+        snapshot.tick_current
+    )
+
+
+@lru_cache(maxsize=None)
+def compile_batch_query(block_count: int) -> str:
+    """
+    生成包含 block_count 个区块别名的查询模板
+
+    模板只与区块数量有关，池子、区块号和tick都通过GraphQL变量传入，因此可以缓存复用
+
+    参数:
+    - block_count: 区块数量
+
+    返回:
+    - str: GraphQL查询
+    """
+    aliases = [f"b{i}" for i in range(block_count)]
+    variables = ", ".join(["$pool: ID!", "$ticks: [ID!]!", "$first: Int!"] + [f"${alias}: Int!" for alias in aliases])
+    selections = "".join(_POOL_SELECTION % {"alias": alias} for alias in aliases)
+    return f"query BatchPool({variables}) {{{selections}\n}}\n"
+
+
+def plan_batches(
+    block_numbers,
+    ticks,
+    max_aliases: int = MAX_ALIASES_PER_QUERY,
+    max_entities: int = MAX_QUERY_ENTITIES,
+    max_response_bytes: int = MAX_RESPONSE_BYTES
+) -> list[tuple[tuple[int, ...], tuple[int, ...]]]:
+    """
+    把 (区块 × tick) 的查询需求拆分成若干批，每批不超过端点的复杂度和响应大小限制
+
+    参数:
+    - block_numbers: 区块号列表
+    - ticks: tick列表
+    - max_aliases: 每个请求的别名数量上限
+    - max_entities: 每个请求的实体数量上限
+    - max_response_bytes: 每个请求的响应大小上限
+
+    返回:
+    - list[tuple[tuple[int, ...], tuple[int, ...]]]: [(区块号, tick), ...]，每一项对应一个请求
+    """
+    blocks = sorted({int(block) for block in block_numbers})
+    tick_list = sorted({int(tick) for tick in ticks})
+    tick_chunks = [
+        tuple(tick_list[i:i + MAX_TICKS_PER_SELECTION])
+        for i in range(0, len(tick_list), MAX_TICKS_PER_SELECTION)
+    ] or [()]
+
+    batches = []
+    for tick_chunk in tick_chunks:
+        entities_per_alias = 1 + len(tick_chunk)
+        bytes_per_alias = EST_POOL_BYTES + EST_TICK_BYTES * len(tick_chunk)
+        size = max(1, min(
+            max_aliases,
+            max_entities // entities_per_alias,
+            max_response_bytes // bytes_per_alias
+        ))
+        for i in range(0, len(blocks), size):
+            batches.append((tuple(blocks[i:i + size]), tick_chunk))
+    return batches
+
+
+def decode_batch_response(data: dict, blocks: tuple) -> dict[int, PoolSnapshot]:
+    """
+    把批量请求的响应按别名拆分回各区块的快照
+
+    参数:
+    - data: 响应中的 data 字段
+    - blocks: 该批请求的区块号，顺序与别名 b0, b1, ... 对应
+
+    返回:
+    - dict[int, PoolSnapshot]: 区块号 -> 快照，池子在该区块不存在时不包含该区块
+    """
+    snapshots = {}
+    for alias, pool_data in data.items():
+        if not pool_data:
+            continue
+        try:
+            block = blocks[int(alias[1:])]
+            snapshots[block] = PoolSnapshot(
+                block_number=block,
+                tick_current=int(pool_data['tick']),
+                fee_growth_global_0_x128=int(pool_data['feeGrowthGlobal0X128']),
+                fee_growth_global_1_x128=int(pool_data['feeGrowthGlobal1X128']),
+                ticks=ticks_to_dict(pool_data.get('ticks') or ())
+            )
+        except (KeyError, IndexError, TypeError, ValueError) as exc:
+            raise MalformedResponseError(f"别名 {alias} 的数据格式错误: {exc!r}")
+    return snapshots
+
+
+def fetch_snapshots(pool_id: str, block_numbers, ticks, url: str = None, session: requests.Session = None) -> dict[int, PoolSnapshot]:
+    """
+    按计划批量获取多个区块下同一组tick的数据
+
+    参数:
+    - pool_id: 池子地址
+    - block_numbers: 区块号列表（int或str）
+    - ticks: tick列表
+    - url: 子图端点，默认使用 GRAPH_API_URL
+    - session: 复用连接的 requests.Session，默认每个请求新建连接
+
+    返回:
+    - dict[int, PoolSnapshot]: 区块号 -> 快照，池子在该区块不存在时不包含该区块
+
+    异常:
+    - SubgraphError: 请求失败或响应格式错误
+    """
+    headers = {
+        "Authorization": f"Bearer {API_KEY}"
+    }
+    snapshots: dict[int, PoolSnapshot] = {}
+
+    for blocks, tick_chunk in plan_batches(block_numbers, ticks):
+        variables = {
+            "pool": pool_id,
+            "ticks": [f"{pool_id}#{tick}" for tick in tick_chunk],
+            "first": max(1, len(tick_chunk)),
+        }
+        for i, block in enumerate(blocks):
+            variables[f"b{i}"] = block
+
+        METRICS.incr("fetch_count")
+        try:
+            with METRICS.stage("fetch"):
+                try:
+                    resp = (session or requests).post(
+                        url or URL,
+                        json={'query': compile_batch_query(len(blocks)), 'variables': variables},
+                        headers=headers,
+                        timeout=SUBGRAPH_TIMEOUT
+                    )
+                except requests.RequestException as exc:
+                    raise SubgraphConnectionError(f"请求子图失败: {exc!r}")
+            METRICS.incr("fetch_bytes", len(resp.content))
+            if resp.status_code >= 400:
+                raise SubgraphHTTPError(resp.status_code, resp.text[:200])
+            with METRICS.stage("json_decode"):
+                data = decode_graphql_body(resp.content)
+            with METRICS.stage("parse"):
+                batch = decode_batch_response(data, blocks)
+        except SubgraphError:
+            METRICS.incr("fetch_errors")
+            raise
+
+        for block, snapshot in batch.items():
+            existing = snapshots.get(block)
+            if existing is None:
+                snapshots[block] = snapshot
+            else:
+                # tick数量超过单次上限时同一区块会分多批返回，这里合并tick
+                existing.ticks.update(snapshot.ticks)
+
+    return snapshots
+
+
+def fetch_indexed_block(url: str = None, session: requests.Session = None) -> int:
+    """
+    查询子图已经索引到的最新区块（_meta），比链上最新区块略晚
+
+    参数:
+    - url: 子图端点，默认使用 GRAPH_API_URL
+    - session: 复用连接的 requests.Session
+
+    返回:
+    - int: 区块号
+
+    异常:
+    - SubgraphError: 请求失败或响应格式错误
+    """
+    METRICS.incr("fetch_count")
+    try:
+        with METRICS.stage("fetch"):
+            try:
+                resp = (session or requests).post(
+                    url or URL,
+                    json={'query': _META_QUERY},
+                    headers={"Authorization": f"Bearer {API_KEY}"},
+                    timeout=SUBGRAPH_TIMEOUT
+                )
+            except requests.RequestException as exc:
+                raise SubgraphConnectionError(f"请求子图失败: {exc!r}")
+        if resp.status_code >= 400:
+            raise SubgraphHTTPError(resp.status_code, resp.text[:200])
+        data = decode_graphql_body(resp.content)
+        try:
+            return int(data["_meta"]["block"]["number"])
+        except (KeyError, TypeError, ValueError) as exc:
+            raise MalformedResponseError(f"_meta 返回数据格式错误: {exc!r}")
+    except SubgraphError:
+        METRICS.incr("fetch_errors")
+        raise
+
+
+#测试代码
+if __name__ == '__main__':
+    pool_id = input("请输入 pool id: ")
+    block_numbers = input("请输入 block number（逗号分隔）: ").split(",")
+    ticks = input("请输入 tick（逗号分隔）: ").split(",")
+
+    print(f"请求计划: {plan_batches(block_numbers, ticks)}")
+    for block, snapshot in sorted(fetch_snapshots(pool_id, block_numbers, ticks).items()):
+        print(f"区块 {block}: tick={snapshot.tick_current}, 已初始化tick数={len(snapshot.ticks)}")
@@ -0,0 +1,266 @@
+import requests
+
+from data_sources import DataSource
+from errors import DataSourceError
+from metrics import METRICS
+from abi import (
+    FEE_GROWTH_GLOBAL_0_SELECTOR,
+    FEE_GROWTH_GLOBAL_1_SELECTOR,
+    SLOT0_SELECTOR,
+    decode_aggregate3_result,
+    decode_word,
+    encode_aggregate3,
+    encode_ticks_call,
+    to_signed,
+)
+from query_planner import PoolSnapshot
+
+# Multicall3 在主网及大多数EVM链上的地址和主网部署区块
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL3_DEPLOY_BLOCK = 14353601
+
+MAX_CALLS_PER_MULTICALL = 500   # 单个 aggregate3 中的调用数量上限
+MAX_RPC_BATCH = 50              # 单个HTTP请求中的JSON-RPC请求数量上限
+RPC_TIMEOUT = 30
+
+class RpcError(DataSourceError):
+    """
+    JSON-RPC请求失败或返回了错误
+    """
+
+
+class RpcSource(DataSource):
+    """
+    归档节点数据源：用 eth_call 在指定区块读取池子合约的 slot0 / feeGrowthGlobal / ticks
+
+    同一区块的所有调用通过Multicall3合并为一个 eth_call（部署区块之前退回逐个调用），
+    多个区块的 eth_call 再合并为一个JSON-RPC批量请求
+    """
+    name = "rpc"
+    block_queries = True
+
+    def __init__(
+        self,
+        url: str,
+        multicall_address: str = MULTICALL3_ADDRESS,
+        multicall_deploy_block: int = MULTICALL3_DEPLOY_BLOCK,
+        request_cost: float = 1.0,
+        call_cost: float = 0.02,
+        session: requests.Session = None
+    ):
+        self.url = url
+        self.multicall_address = multicall_address
+        self.multicall_deploy_block = multicall_deploy_block
+        self.request_cost = request_cost
+        self.call_cost = call_cost
+        self.session = session or requests.Session()
+
+    def _plan(self, pool_id: str, blocks: list[int], ticks: list[int]) -> tuple[list, list]:
+        calls = [
+            (pool_id, SLOT0_SELECTOR),
+            (pool_id, FEE_GROWTH_GLOBAL_0_SELECTOR),
+            (pool_id, FEE_GROWTH_GLOBAL_1_SELECTOR),
+        ] + [(pool_id, encode_ticks_call(tick)) for tick in ticks]
+
+        # 每一项: (区块号, 对应的调用下标, eth_call参数, 是否为multicall)
+        jobs = []
+        for block in blocks:
+            if self.multicall_address and block >= self.multicall_deploy_block:
+                for i in range(0, len(calls), MAX_CALLS_PER_MULTICALL):
+                    indexes = list(range(i, min(i + MAX_CALLS_PER_MULTICALL, len(calls))))
+                    data = encode_aggregate3([calls[j] for j in indexes])
+                    jobs.append((block, indexes, {"to": self.multicall_address, "data": "0x" + data.hex()}, True))
+            else:
+                for j, (target, data) in enumerate(calls):
+                    jobs.append((block, [j], {"to": target, "data": "0x" + data.hex()}, False))
+        return calls, jobs
+
+    def cost(self, pool_id: str, block_numbers, ticks) -> float:
+        if not self.url:
+            return None
+        # 与 _plan 的拆分方式相同，但只计数不编码：每个区块 slot0、两个全局增长和每个tick各一个调用
+        blocks = {int(block) for block in block_numbers}
+        calls = len({int(tick) for tick in ticks}) + 3
+        if self.multicall_address:
+            multicall_blocks = sum(1 for block in blocks if block >= self.multicall_deploy_block)
+        else:
+            multicall_blocks = 0
+        jobs = multicall_blocks * -(-calls // MAX_CALLS_PER_MULTICALL) + (len(blocks) - multicall_blocks) * calls
+        requests_needed = -(-jobs // MAX_RPC_BATCH)
+        return requests_needed * self.request_cost + calls * len(blocks) * self.call_cost
+
+    def _post(self, batch: list[dict]) -> dict:
+        METRICS.incr("fetch_count")
+        METRICS.incr("rpc_calls", len(batch))
+        try:
+            with METRICS.stage("fetch"):
+                try:
+                    resp = self.session.post(self.url, json=batch, timeout=RPC_TIMEOUT)
+                except requests.RequestException as exc:
+                    raise RpcError(f"请求节点失败: {exc!r}")
+            METRICS.incr("fetch_bytes", len(resp.content))
+            if resp.status_code >= 400:
+                raise RpcError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+            with METRICS.stage("json_decode"):
+                try:
+                    items = resp.json()
+                except ValueError as exc:
+                    raise RpcError(f"响应不是JSON: {exc}")
+            if not isinstance(items, list):
+                raise RpcError(f"批量请求返回了非数组响应: {str(items)[:200]}")
+
+            results = {}
+            for item in items:
+                if not isinstance(item, dict) or "id" not in item:
+                    raise RpcError(f"JSON-RPC返回格式错误: {str(item)[:200]}")
+                if item.get("error"):
+                    raise RpcError(f"JSON-RPC请求失败: {item['error']}")
+                results[item["id"]] = item.get("result")
+            return results
+        except RpcError:
+            METRICS.incr("fetch_errors")
+            raise
+
+    def get_snapshots(self, pool_id: str, block_numbers, ticks) -> dict[int, PoolSnapshot]:
+        """
+        获取多个区块下同一组tick的快照，签名与 fetch_snapshots 相同
+
+        参数:
+        - pool_id: 池子地址
+        - block_numbers: 区块号列表
+        - ticks: tick列表
+
+        返回:
+        - dict[int, PoolSnapshot]: 区块号 -> 快照，池子在该区块尚未部署时不包含该区块；未初始化的tick不包含在快照中
+        """
+        blocks = sorted({int(block) for block in block_numbers})
+        tick_list = sorted({int(tick) for tick in ticks})
+        calls, jobs = self._plan(pool_id, blocks, tick_list)
+        returns = {block: [None] * len(calls) for block in blocks}
+
+        for i in range(0, len(jobs), MAX_RPC_BATCH):
+            batch = jobs[i:i + MAX_RPC_BATCH]
+            results = self._post([
+                {"jsonrpc": "2.0", "id": k, "method": "eth_call", "params": [call, hex(block)]}
+                for k, (block, _, call, _) in enumerate(batch)
+            ])
+            with METRICS.stage("parse"):
+                for k, (block, indexes, _, is_multicall) in enumerate(batch):
+                    if k not in results:
+                        raise RpcError(f"批量请求缺少 id={k} 的结果")
+                    try:
+                        result = bytes.fromhex(results[k][2:])
+                    except (TypeError, ValueError) as exc:
+                        raise RpcError(f"eth_call返回格式错误: {exc!r}")
+                    if is_multicall:
+                        try:
+                            decoded = decode_aggregate3_result(result)
+                        except ValueError as exc:
+                            raise RpcError(f"aggregate3返回格式错误: {exc}")
+                        for j, (success, data) in zip(indexes, decoded):
+                            returns[block][j] = data if success else None
+                    else:
+                        returns[block][indexes[0]] = result
+
+        snapshots = {}
+        with METRICS.stage("parse"):
+            for block, values in returns.items():
+                slot0, global_0, global_1 = values[:3]
+                # 池子尚未部署时调用返回空数据
+                if not slot0 or not global_0 or not global_1:
+                    continue
+                ticks_data = {}
+                for tick, data in zip(tick_list, values[3:]):
+                    # ticks(int24) 返回 (liquidityGross, liquidityNet, feeGrowthOutside0X128, feeGrowthOutside1X128, ..., initialized)
+                    if data and len(data) >= 256 and decode_word(data, 224):
+                        ticks_data[tick] = (decode_word(data, 64), decode_word(data, 96))
+                try:
+                    snapshots[block] = PoolSnapshot(
+                        block_number=block,
+                        tick_current=to_signed(decode_word(slot0, 32)),
+                        fee_growth_global_0_x128=decode_word(global_0, 0),
+                        fee_growth_global_1_x128=decode_word(global_1, 0),
+                        ticks=ticks_data
+                    )
+                except ValueError as exc:
+                    raise RpcError(f"区块 {block} 的返回数据格式错误: {exc}")
+        return snapshots
+
+    def get_block_timestamps(self, block_numbers) -> dict[int, int]:
+        """
+        用 eth_getBlockByNumber 批量获取区块时间戳
+
+        参数:
+        - block_numbers: 区块号列表
+
+        返回:
+        - dict[int, int]: 区块号 -> 时间戳（秒），尚未产生的区块不包含在内
+        """
+        blocks = sorted({int(block) for block in block_numbers})
+        timestamps = {}
+        for i in range(0, len(blocks), MAX_RPC_BATCH):
+            batch = blocks[i:i + MAX_RPC_BATCH]
+            results = self._post([
+                {"jsonrpc": "2.0", "id": k, "method": "eth_getBlockByNumber", "params": [hex(block), False]}
+                for k, block in enumerate(batch)
+            ])
+            with METRICS.stage("parse"):
+                for k, block in enumerate(batch):
+                    header = results.get(k)
+                    if header is None:
+                        continue
+                    try:
+                        timestamps[block] = int(header["timestamp"], 16)
+                    except (KeyError, TypeError, ValueError) as exc:
+                        raise RpcError(f"区块 {block} 的返回数据格式错误: {exc!r}")
+        return timestamps
+
+    def get_latest_block(self) -> tuple[int, int]:
+        """
+        返回:
+        - tuple[int, int]: (最新区块号, 时间戳)
+        """
+        header = self._post([{"jsonrpc": "2.0", "id": 0, "method": "eth_getBlockByNumber", "params": ["latest", False]}]).get(0)
+        try:
+            return int(header["number"], 16), int(header["timestamp"], 16)
+        except (KeyError, TypeError, ValueError) as exc:
+            raise RpcError(f"最新区块的返回数据格式错误: {exc!r}")
+
+
+# 对照检查：用假节点和假子图（数据一致）分别获取同一组快照，覆盖Multicall3部署前（逐个eth_call）和部署后的区块
+if __name__ == "__main__":
+    import sys
+
+    from data_sources import SubgraphSource
+    from stub_servers import StubRpcHandler, StubSubgraphHandler, start_stub_server
+
+    rpc_server, rpc_handler = start_stub_server(StubRpcHandler)
+    subgraph_server, subgraph_handler = start_stub_server(StubSubgraphHandler)
+    rpc = RpcSource(f"http://127.0.0.1:{rpc_server.server_address[1]}/")
+    subgraph = SubgraphSource(f"http://127.0.0.1:{subgraph_server.server_address[1]}/")
+
+    pool_id = "0x4e68ccd3e89f51c3074ca5072bbac773960dfa36"
+    # tick数量超过 MAX_CALLS_PER_MULTICALL，部署后的区块需要拆成多个 aggregate3
+    ticks = list(range(-200580, -200580 + 60 * 600, 60))
+    cases = {
+        "Multicall3部署前": [MULTICALL3_DEPLOY_BLOCK - 1000, MULTICALL3_DEPLOY_BLOCK - 1],
+        "Multicall3部署后": [MULTICALL3_DEPLOY_BLOCK, MULTICALL3_DEPLOY_BLOCK + 1, 23438173],
+    }
+    failed = False
+    for name, blocks in cases.items():
+        rpc_calls = rpc_handler.request_count
+        from_rpc = rpc.get_snapshots(pool_id, blocks, ticks)
+        from_subgraph = subgraph.get_snapshots(pool_id, blocks, ticks)
+        mismatched = [
+            block for block in blocks
+            if block not in from_rpc or from_rpc.get(block) != from_subgraph.get(block)
+        ]
+        failed = failed or bool(mismatched)
+        print(
+            f"{name}: 区块 {blocks}, {len(ticks)} 个tick, RPC HTTP请求 {rpc_handler.request_count - rpc_calls} 次, "
+            f"{'一致' if not mismatched else f'不一致的区块: {mismatched}'}"
+        )
+
+    rpc_server.shutdown()
+    subgraph_server.shutdown()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,300 @@
+import json
+import mmap
+import struct
+import threading
+import zlib
+from bisect import bisect_left
+
+from data_sources import DataSource, atomic_write, merge_snapshot_record, record_to_snapshot
+from errors import DataSourceError
+from query_planner import PoolSnapshot
+
+# 快照包文件格式:
+#   MAGIC
+#   每个 (pool, block) 一条zlib压缩的JSON记录（格式与 FileSource 相同）
+#   元数据: zlib压缩的JSON {"pools": [...], "block_timestamps": {...}, "latest_block": [...]}
+#   索引: 按 (池子序号, 区块号) 排序的定长记录 (池子序号, 区块号, 偏移, 长度)
+#   尾部: (元数据偏移, 元数据长度, 索引偏移, 索引条数, MAGIC)
+# 打开时只读取尾部和元数据，查询时在mmap上二分索引，只解压需要的记录
+MAGIC = b"LPSNAP01"
+_INDEX_ENTRY = struct.Struct(">IQQI")
+_FOOTER = struct.Struct(">QIQQ8s")
+
+# 压缩预置字典：单条记录很小，用记录中反复出现的字段名提高压缩率
+_ZDICT = b'{"queried_ticks": [], "ticks": {}, "tick": , "feeGrowthGlobal0X128": "", "feeGrowthGlobal1X128": ""}'
+
+
+class BundleError(DataSourceError):
+    """
+    快照包文件损坏或格式不符
+    """
+
+
+def _compress(data: bytes) -> bytes:
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zdict=_ZDICT)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(data: bytes) -> bytes:
+    decompressor = zlib.decompressobj(zdict=_ZDICT)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def write_bundle(path: str, records: dict, block_timestamps: dict = None, latest_block: tuple = None) -> None:
+    """
+    写出快照包（先写唯一的临时文件再替换）
+
+    参数:
+    - path: 文件路径
+    - records: (pool_id, 区块号) -> 快照JSON记录（见 data_sources.merge_snapshot_record）
+    - block_timestamps: 区块号 -> 时间戳，用于离线按时间查找区块
+    - latest_block: (最新区块号, 时间戳)，离线重放时作为 "now"
+    """
+    pools = sorted({pool_id for pool_id, _ in records})
+    pool_index = {pool_id: i for i, pool_id in enumerate(pools)}
+    index = []
+    with atomic_write(path, "wb") as f:
+        f.write(MAGIC)
+        for pool_id, block in sorted(records, key=lambda key: (pool_index[key[0]], key[1])):
+            data = _compress(json.dumps(records[(pool_id, block)], separators=(",", ":")).encode("utf-8"))
+            index.append((pool_index[pool_id], block, f.tell(), len(data)))
+            f.write(data)
+
+        meta = _compress(json.dumps({
+            "pools": pools,
+            "block_timestamps": {str(block): timestamp for block, timestamp in sorted((block_timestamps or {}).items())},
+            "latest_block": list(latest_block) if latest_block else None,
+        }).encode("utf-8"))
+        meta_offset = f.tell()
+        f.write(meta)
+        index_offset = f.tell()
+        f.write(b"".join(_INDEX_ENTRY.pack(*entry) for entry in index))
+        f.write(_FOOTER.pack(meta_offset, len(meta), index_offset, len(index), MAGIC))
+
+
+class _IndexKeys:
+    """
+    把mmap中的定长索引包装成序列，供 bisect 二分 (池子序号, 区块号)
+    """
+
+    def __init__(self, buffer, offset: int, count: int):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> tuple:
+        return self.entry(i)[:2]
+
+    def entry(self, i: int) -> tuple:
+        return _INDEX_ENTRY.unpack_from(self.buffer, self.offset + i * _INDEX_ENTRY.size)
+
+
+class SnapshotBundle(DataSource):
+    """
+    从快照包读取快照的只读数据源，用于离线、可复现地重新计算
+
+    打开时只读取尾部和元数据（池子列表、区块时间戳），快照记录在查询时按索引读取并解压，
+    大文件也可以立即打开；快照包中没有的区块不出现在结果中，与其他数据源的行为一致
+    """
+    name = "bundle"
+    block_queries = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self._buffer) < len(MAGIC) + _FOOTER.size or self._buffer[:len(MAGIC)] != MAGIC:
+                raise BundleError(f"不是快照包文件: {path}")
+            meta_offset, meta_length, index_offset, index_count, magic = _FOOTER.unpack_from(self._buffer, len(self._buffer) - _FOOTER.size)
+            if magic != MAGIC or index_offset + index_count * _INDEX_ENTRY.size + _FOOTER.size != len(self._buffer):
+                raise BundleError(f"快照包尾部损坏: {path}")
+            meta = json.loads(_decompress(self._buffer[meta_offset:meta_offset + meta_length]))
+        except (ValueError, zlib.error) as exc:
+            self.close()
+            raise BundleError(f"快照包元数据损坏: {path}: {exc}")
+        except BaseException:
+            self.close()
+            raise
+        self._pools = {pool_id: i for i, pool_id in enumerate(meta["pools"])}
+        self.block_timestamps = {int(block): timestamp for block, timestamp in meta["block_timestamps"].items()}
+        self.latest_block = tuple(meta["latest_block"]) if meta["latest_block"] else None
+        self._index = _IndexKeys(self._buffer, index_offset, index_count)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def close(self) -> None:
+        if getattr(self, "_buffer", None) is not None:
+            self._buffer.close()
+            self._buffer = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, pool_id: str, block: int) -> dict:
+        """
+        返回:
+        - dict: (pool, block) 的快照JSON记录，不存在时为None
+        """
+        pool_index = self._pools.get(pool_id.lower())
+        if pool_index is None:
+            return None
+        key = (pool_index, int(block))
+        i = bisect_left(self._index, key)
+        if i == len(self._index):
+            return None
+        entry = self._index.entry(i)
+        if entry[:2] != key:
+            return None
+        _, _, offset, length = entry
+        try:
+            return json.loads(_decompress(self._buffer[offset:offset + length]))
+        except (ValueError, zlib.error) as exc:
+            raise BundleError(f"快照包中 {pool_id}@{block} 的记录损坏: {exc}")
+
+    def blocks(self, pool_id: str) -> list[int]:
+        """
+        返回:
+        - list[int]: 快照包中该池子的所有区块号（升序）
+        """
+        pool_index = self._pools.get(pool_id.lower())
+        if pool_index is None:
+            return []
+        start = bisect_left(self._index, (pool_index, 0))
+        end = bisect_left(self._index, (pool_index + 1, 0))
+        return [self._index[i][1] for i in range(start, end)]
+
+    def pools(self) -> list[str]:
+        return list(self._pools)
+
+    def cost(self, pool_id: str, block_numbers, ticks) -> float:
+        return 0.0
+
+    def get_snapshots(self, pool_id: str, block_numbers, ticks) -> dict[int, PoolSnapshot]:
+        wanted = {int(tick) for tick in ticks}
+        snapshots = {}
+        for block in {int(block) for block in block_numbers}:
+            record = self.record(pool_id, block)
+            if record is None or not wanted <= set(record["queried_ticks"]):
+                continue
+            snapshots[block] = record_to_snapshot(block, record)
+        return snapshots
+
+    def get_block_timestamps(self, block_numbers) -> dict[int, int]:
+        return {int(block): self.block_timestamps[int(block)] for block in block_numbers if int(block) in self.block_timestamps}
+
+    def get_latest_block(self) -> tuple[int, int]:
+        if self.latest_block is None:
+            raise BundleError("快照包中没有记录最新区块")
+        return self.latest_block
+
+
+class BundleRecorder(DataSource):
+    """
+    包装另一个数据源，记录经过它的所有快照和区块时间戳，结束时用 export 写出快照包
+
+    同一 (pool, block) 多次查询不同的tick时合并记录
+    """
+    name = "recorder"
+
+    def __init__(self, source: DataSource):
+        self.source = source
+        self._records: dict = {}
+        self._block_timestamps: dict[int, int] = {}
+        self._latest_block = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def cost(self, pool_id: str, block_numbers, ticks) -> float:
+        return self.source.cost(pool_id, block_numbers, ticks)
+
+    def get_snapshots(self, pool_id: str, block_numbers, ticks) -> dict[int, PoolSnapshot]:
+        snapshots = self.source.get_snapshots(pool_id, block_numbers, ticks)
+        with self._lock:
+            for block, snapshot in snapshots.items():
+                key = (pool_id.lower(), int(block))
+                self._records[key] = merge_snapshot_record(self._records.get(key), snapshot, ticks)
+        return snapshots
+
+    @property
+    def block_queries(self) -> bool:
+        return self.source.block_queries
+
+    def get_head_block(self) -> int:
+        # 能查询区块时经过 get_latest_block，最新区块也记录到快照包
+        if self.block_queries:
+            return self.get_latest_block()[0]
+        return self.source.get_head_block()
+
+    def get_block_timestamps(self, block_numbers) -> dict[int, int]:
+        timestamps = self.source.get_block_timestamps(block_numbers)
+        with self._lock:
+            self._block_timestamps.update(timestamps)
+        return timestamps
+
+    def get_latest_block(self) -> tuple[int, int]:
+        latest = self.source.get_latest_block()
+        with self._lock:
+            self._latest_block = latest
+            self._block_timestamps[latest[0]] = latest[1]
+        return latest
+
+    def merge_bundle(self, bundle: SnapshotBundle) -> None:
+        """
+        合并另一个快照包中的记录（如批量计算时各工作进程分别记录的快照包），同一 (pool, block) 的tick合并
+
+        参数:
+        - bundle: 快照包
+        """
+        with self._lock:
+            for pool_id in bundle.pools():
+                for block in bundle.blocks(pool_id):
+                    key = (pool_id, block)
+                    record = bundle.record(pool_id, block)
+                    existing = self._records.get(key)
+                    if existing is not None:
+                        record["queried_ticks"] = sorted(set(existing["queried_ticks"]) | set(record["queried_ticks"]))
+                        record["ticks"] = {**existing["ticks"], **record["ticks"]}
+                    self._records[key] = record
+            self._block_timestamps.update(bundle.block_timestamps)
+            if bundle.latest_block and (self._latest_block is None or bundle.latest_block[0] > self._latest_block[0]):
+                self._latest_block = bundle.latest_block
+
+    def export(self, path: str, block_index=None) -> None:
+        """
+        写出快照包
+
+        参数:
+        - path: 文件路径
+        - block_index: 可选的 block_resolver.BlockIndex；按时间查找区块时部分结果可能直接来自本地索引，
+          一并写入才能在离线重放时得到相同的区块
+        """
+        with self._lock:
+            block_timestamps = dict(self._block_timestamps)
+            if block_index is not None:
+                block_timestamps.update(zip(block_index.blocks, block_index.timestamps))
+            write_bundle(path, self._records, block_timestamps, self._latest_block)
+
+
+# 示例用法
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 2:
+        print("用法: python snapshot_bundle.py <快照包>")
+        sys.exit(1)
+    with SnapshotBundle(sys.argv[1]) as bundle:
+        print(f"快照数量: {len(bundle)}, 区块时间戳数量: {len(bundle.block_timestamps)}, 最新区块: {bundle.latest_block}")
+        for pool_id in bundle.pools():
+            blocks = bundle.blocks(pool_id)
+            print(f"{pool_id}: {len(blocks)} 个区块 ({blocks[0]} ~ {blocks[-1]})")
@@ -0,0 +1,131 @@
+import threading
+from collections import OrderedDict
+
+from metrics import METRICS
+from query_planner import PoolSnapshot, fetch_snapshots
+
+# 缓存的 (pool, block) 快照数量上限
+DEFAULT_MAX_ENTRIES = 100_000
+# 距最新区块至少这么多个确认的区块才视为不会再被重组（约两个epoch，合并后的最终确认深度）
+FINALITY_CONFIRMATIONS = 64
+
+
+class _Flight:
+    """
+    一次正在进行的批量请求，其他线程可以等待它的结果
+    """
+    __slots__ = ("ticks", "event", "result", "error")
+
+    def __init__(self, ticks: frozenset):
+        self.ticks = ticks
+        self.event = threading.Event()
+        self.result: dict[int, PoolSnapshot] = {}
+        # 发起请求的线程遇到的异常，等待者重新抛出，而不是把失败当作"没有数据"
+        self.error: Exception = None
+
+
+class SnapshotCache:
+    """
+    线程安全的 (pool, block) 快照缓存
+
+    - 已确定区块的状态不会再变化，因此成功取到的快照可以一直缓存（按LRU淘汰）；
+      设置 finalized_block（返回当前已确定的最高区块号的函数）时，高于它的区块可能被重组，
+      每次都重新获取，不读写缓存
+    - 并发请求同一个 (pool, block) 时只发出一次请求，其余请求等待并共享结果
+    - 请求失败的区块不缓存，下次重新获取；等待同一请求的线程会收到同一个异常
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, fetch=fetch_snapshots, finalized_block=None):
+        self.max_entries = max_entries
+        self._fetch = fetch
+        self._finalized_block = finalized_block
+        self._lock = threading.Lock()
+        # (pool_id, block) -> (PoolSnapshot, 已查询过的tick集合)
+        self._entries: OrderedDict = OrderedDict()
+        self._inflight: dict[tuple[str, int], _Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, pool_id: str, block_numbers, ticks) -> dict[int, PoolSnapshot]:
+        """
+        获取多个区块下同一组tick的快照，优先使用缓存
+
+        参数:
+        - pool_id: 池子地址
+        - block_numbers: 区块号列表（int或str）
+        - ticks: tick列表
+
+        返回:
+        - dict[int, PoolSnapshot]: 区块号 -> 快照，数据源中没有的区块不包含在结果中
+
+        异常:
+        - 数据源请求失败时抛出数据源的异常（包括等待其他线程的同一请求时）
+        """
+        pool_id = pool_id.lower()
+        tick_set = frozenset(int(tick) for tick in ticks)
+        result: dict[int, PoolSnapshot] = {}
+        to_fetch: list[int] = []
+        waits: list[tuple[int, _Flight]] = []
+        finalized = self._finalized_block() if self._finalized_block is not None else None
+
+        with self._lock:
+            for block in {int(block) for block in block_numbers}:
+                key = (pool_id, block)
+                entry = self._entries.get(key) if finalized is None or block <= finalized else None
+                if entry is not None and tick_set <= entry[1]:
+                    self._entries.move_to_end(key)
+                    METRICS.incr("cache_hits")
+                    result[block] = entry[0]
+                    continue
+                flight = self._inflight.get(key)
+                if flight is not None and tick_set <= flight.ticks:
+                    METRICS.incr("coalesced_fetches")
+                    waits.append((block, flight))
+                else:
+                    to_fetch.append(block)
+
+            if to_fetch:
+                own_flight = _Flight(tick_set)
+                for block in to_fetch:
+                    self._inflight[(pool_id, block)] = own_flight
+
+        if to_fetch:
+            fetched: dict[int, PoolSnapshot] = {}
+            try:
+                fetched = self._fetch(pool_id, to_fetch, sorted(tick_set))
+            except Exception as exc:
+                own_flight.error = exc
+                raise
+            finally:
+                with self._lock:
+                    for block in to_fetch:
+                        key = (pool_id, block)
+                        if self._inflight.get(key) is own_flight:
+                            del self._inflight[key]
+                        if block in fetched and (finalized is None or block <= finalized):
+                            self._store(key, fetched[block], tick_set)
+                own_flight.result = fetched
+                own_flight.event.set()
+            result.update(fetched)
+
+        for block, flight in waits:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            if block in flight.result:
+                result[block] = flight.result[block]
+
+        return result
+
+    def _store(self, key: tuple[str, int], snapshot: PoolSnapshot, tick_set: frozenset) -> None:
+        # 调用方需持有锁
+        entry = self._entries.get(key)
+        if entry is not None:
+            # 合并之前查询过的tick，生成新的快照而不修改已经交给调用方的对象
+            snapshot = snapshot._replace(ticks={**entry[0].ticks, **snapshot.ticks})
+            tick_set = tick_set | entry[1]
+        self._entries[key] = (snapshot, tick_set)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
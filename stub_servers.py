@@ -0,0 +1,191 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from abi import (
+    FEE_GROWTH_GLOBAL_0_SELECTOR,
+    FEE_GROWTH_GLOBAL_1_SELECTOR,
+    SLOT0_SELECTOR,
+    TICKS_SELECTOR,
+    decode_aggregate3_calls,
+    encode_aggregate3_result,
+    encode_word,
+)
+
+# 本地测试用的假数据源，返回值只依赖于区块号和tick，结果可复现
+
+STUB_TICK_CURRENT = -195000
+STUB_LATEST_BLOCK = 23_500_000
+STUB_GENESIS_TIMESTAMP = 1438269973
+STUB_MERGE_BLOCK = 15537394
+
+
+def stub_pool_state(block: int) -> tuple[int, int, int]:
+    """
+    返回:
+    - tuple[int, int, int]: (当前tick, 全局token0手续费增长, 全局token1手续费增长)
+    """
+    return STUB_TICK_CURRENT + block % 1000, block * 10 ** 30, block * 3 * 10 ** 28
+
+
+def stub_block_timestamp(block: int) -> int:
+    """
+    合并前约13秒、合并后12秒一个区块，再叠加0~6秒的抖动，时间戳仍严格递增
+    """
+    return (
+        STUB_GENESIS_TIMESTAMP + 13 * min(block, STUB_MERGE_BLOCK) + 12 * max(0, block - STUB_MERGE_BLOCK)
+        + block * 7919 % 7
+    )
+
+
+def stub_tick_state(block: int, tick: int) -> tuple[int, int]:
+    """
+    返回:
+    - tuple[int, int]: (tick外侧token0手续费增长, tick外侧token1手续费增长)
+    """
+    return (abs(tick) * 7919 + block) * 10 ** 24, (abs(tick) * 104729 + block) * 10 ** 21
+
+
+class StubSubgraphHandler(BaseHTTPRequestHandler):
+    """
+    只实现 query_planner 批量查询和 _meta 最新区块查询的假子图端点
+    """
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，关闭Nagle避免与客户端的延迟ACK叠加出40ms延迟
+    disable_nagle_algorithm = True
+    latency = 0.0
+    request_count = 0
+    _count_lock = threading.Lock()
+
+    def do_POST(self):
+        with self._count_lock:
+            type(self).request_count += 1
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        variables = body.get("variables") or {}
+        tick_ids = variables.get("ticks") or []
+
+        data = {}
+        if "_meta" in body.get("query", ""):
+            data["_meta"] = {"block": {"number": STUB_LATEST_BLOCK}}
+        index = 0
+        while f"b{index}" in variables:
+            block = int(variables[f"b{index}"])
+            tick_current, global_0, global_1 = stub_pool_state(block)
+            ticks = []
+            for tick_id in tick_ids:
+                tick = int(tick_id.rsplit("#", 1)[1])
+                outside_0, outside_1 = stub_tick_state(block, tick)
+                ticks.append({
+                    "tickIdx": str(tick),
+                    "feeGrowthOutside0X128": str(outside_0),
+                    "feeGrowthOutside1X128": str(outside_1),
+                })
+            data[f"b{index}"] = {
+                "tick": str(tick_current),
+                "feeGrowthGlobal0X128": str(global_0),
+                "feeGrowthGlobal1X128": str(global_1),
+                "ticks": ticks,
+            }
+            index += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        payload = json.dumps({"data": data}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def stub_eth_call(data: bytes, block: int) -> bytes:
+    """
+    按函数选择器返回池子合约在该区块的假数据（ABI编码）
+    """
+    tick_current, global_0, global_1 = stub_pool_state(block)
+    selector = data[:4]
+    if selector == SLOT0_SELECTOR:
+        # (sqrtPriceX96, tick, observationIndex, observationCardinality, observationCardinalityNext, feeProtocol, unlocked)
+        return encode_word(1 << 96) + encode_word(tick_current) + encode_word(0) * 4 + encode_word(1)
+    if selector == FEE_GROWTH_GLOBAL_0_SELECTOR:
+        return encode_word(global_0)
+    if selector == FEE_GROWTH_GLOBAL_1_SELECTOR:
+        return encode_word(global_1)
+    if selector == TICKS_SELECTOR:
+        tick = int.from_bytes(data[4:36], "big", signed=True)
+        outside_0, outside_1 = stub_tick_state(block, tick)
+        return encode_word(1) + encode_word(0) + encode_word(outside_0) + encode_word(outside_1) + encode_word(0) * 3 + encode_word(1)
+    raise ValueError(f"未知的函数选择器: {selector.hex()}")
+
+
+class StubRpcHandler(BaseHTTPRequestHandler):
+    """
+    只实现 eth_call（含Multicall3 aggregate3）和 eth_getBlockByNumber 的假JSON-RPC端点，数据与 StubSubgraphHandler 一致
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.0
+    request_count = 0
+    multicall_address = "0xca11bde05977b3631167028862be2a173976ca11"
+    _count_lock = threading.Lock()
+
+    def _call(self, request: dict) -> dict:
+        if request.get("method") == "eth_getBlockByNumber":
+            block_tag = request["params"][0]
+            block = STUB_LATEST_BLOCK if block_tag == "latest" else int(block_tag, 16)
+            header = None
+            if block <= STUB_LATEST_BLOCK:
+                header = {"number": hex(block), "timestamp": hex(stub_block_timestamp(block))}
+            return {"jsonrpc": "2.0", "id": request.get("id"), "result": header}
+        if request.get("method") != "eth_call":
+            return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32601, "message": "method not found"}}
+        call, block_tag = request["params"]
+        block = int(block_tag, 16)
+        data = bytes.fromhex(call["data"][2:])
+        if call["to"].lower() == self.multicall_address:
+            result = encode_aggregate3_result([(True, stub_eth_call(sub_data, block)) for _, sub_data in decode_aggregate3_calls(data)])
+        else:
+            result = stub_eth_call(data, block)
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": "0x" + result.hex()}
+
+    def do_POST(self):
+        with self._count_lock:
+            type(self).request_count += 1
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        response = [self._call(item) for item in body] if isinstance(body, list) else self._call(body)
+
+        if self.latency:
+            time.sleep(self.latency)
+        payload = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(handler_class, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+    """
+    在后台线程启动假数据源
+
+    参数:
+    - handler_class: 请求处理类
+    - latency: 每个请求额外的延迟（秒），用于模拟网络
+    - host: 监听地址
+    - port: 监听端口，0表示随机端口
+
+    返回:
+    - tuple[ThreadingHTTPServer, type]: (服务器, 绑定的处理类，可读取 request_count)
+    """
+    handler = type(f"Bound{handler_class.__name__}", (handler_class,), {"latency": latency, "request_count": 0})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler
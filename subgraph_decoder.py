@@ -0,0 +1,125 @@
+import json
+
+from errors import DataSourceError
+
+
+class SubgraphError(DataSourceError):
+    """
+    子图请求失败的基类
+    """
+
+
+class SubgraphConnectionError(SubgraphError):
+    """
+    请求子图端点失败（连接错误、超时等），没有拿到响应
+    """
+
+
+class MalformedResponseError(SubgraphError):
+    """
+    响应不是合法的JSON，或结构与查询不符
+    """
+
+
+class SubgraphHTTPError(SubgraphError):
+    """
+    子图端点返回了非2xx状态码
+    """
+
+    def __init__(self, status: int, body: str = ""):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status = status
+
+
+class SubgraphQueryError(SubgraphError):
+    """
+    子图返回了 errors 字段（查询错误、索引未同步到该区块等）
+    """
+
+    def __init__(self, errors: list):
+        message = errors[0].get("message") if errors and isinstance(errors[0], dict) else str(errors)
+        super().__init__(message)
+        self.errors = errors
+
+
+def check_graphql_document(document) -> dict:
+    """
+    校验GraphQL响应的外层结构
+
+    参数:
+    - document: 解析后的响应
+
+    返回:
+    - dict: data 字段
+    """
+    if not isinstance(document, dict):
+        raise MalformedResponseError(f"响应不是对象: {type(document).__name__}")
+    if document.get("errors"):
+        raise SubgraphQueryError(document["errors"])
+    data = document.get("data")
+    if not isinstance(data, dict):
+        raise MalformedResponseError("响应缺少 data 字段")
+    return data
+
+
+def decode_graphql_body(body) -> dict:
+    """
+    解析完整响应体
+
+    256位整数字符串的int转换占了解码的大部分时间，json.loads 之外的自定义扫描并不能更快
+
+    参数:
+    - body: 响应体（bytes或str）
+
+    返回:
+    - dict: data 字段
+    """
+    try:
+        document = json.loads(body)
+    except (ValueError, TypeError) as exc:
+        raise MalformedResponseError(f"响应不是JSON: {exc}")
+    return check_graphql_document(document)
+
+
+def ticks_to_dict(rows) -> dict:
+    """
+    把tick行转换为整数
+
+    参数:
+    - rows: [{"tickIdx", "feeGrowthOutside0X128", "feeGrowthOutside1X128"}, ...]
+
+    返回:
+    - dict: tick -> (fee_growth_outside_0_x128, fee_growth_outside_1_x128)
+    """
+    try:
+        return {
+            int(row["tickIdx"]): (int(row["feeGrowthOutside0X128"]), int(row["feeGrowthOutside1X128"]))
+            for row in rows
+        }
+    except (KeyError, TypeError, ValueError) as exc:
+        raise MalformedResponseError(f"tick数据格式错误: {exc!r}")
+
+
+# 示例用法
+if __name__ == "__main__":
+    import time
+
+    rows = [
+        {"tickIdx": str(tick), "feeGrowthOutside0X128": str(2 ** 250 + tick), "feeGrowthOutside1X128": str(2 ** 251 + tick)}
+        for tick in range(-100000, 100000, 10)
+    ]
+    body = json.dumps({"data": {"b0": {"tick": "0", "feeGrowthGlobal0X128": "1", "feeGrowthGlobal1X128": "2", "ticks": rows}}}).encode()
+    print(f"响应大小: {len(body) / 1e6:.1f} MB, tick数量: {len(rows)}")
+
+    start = time.perf_counter()
+    data = decode_graphql_body(body)
+    print(f"json.loads: {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    converted = ticks_to_dict(data["b0"]["ticks"])
+    print(f"256位整数转换: {time.perf_counter() - start:.3f}s, tick数量一致: {len(converted) == len(rows)}")
+
+    try:
+        decode_graphql_body(b'{"errors": [{"message": "indexing_error"}]}')
+    except SubgraphQueryError as exc:
+        print(f"SubgraphQueryError: {exc}")